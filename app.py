@@ -1,26 +1,215 @@
+import bisect
 import os
+
+# 'threading' runs the Werkzeug development server. 'eventlet' and 'gevent'
+# serve every client from one event loop and must patch the standard library
+# before anything else is imported.
+ASYNC_MODE = os.environ.get('CHAT_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
 import subprocess
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_app_context, has_request_context
 from flask_cors import CORS
+import functools
+import html
+import json
+import signal
 import sqlite3
+import sys
+import time
 from datetime import datetime
 import uuid
 from flask_socketio import SocketIO, emit, join_room, leave_room
+from db import ConnectionPool, GroupCommitter, QueryProfiler, WriteBehindBuffer, thread_offloader
+from cache import MembershipCache, UserDirectory, VersionCounters
+from metrics import COUNT_BUCKETS, Registry
+import mq
+import wire
+import migrate
 
 
 
 app = Flask(__name__)
-CORS(app)
-DB = 'chat.db'
+app.json = wire.NegotiatingJSONProvider(app)
+CORS(app, expose_headers=['ETag'])
+DB = os.environ.get('CHAT_DB', 'chat.db')
+DB_PROFILE = os.environ.get('CHAT_DB_PROFILE', 'durable')
+# 'receipts' stores one message_reads row per message per reader (Option C);
+# 'watermark' stores one last_read_message_id per conversation member.
+READ_MODEL = os.environ.get('CHAT_READ_MODEL', 'receipts')
+MIGRATE_ON_START = os.environ.get('CHAT_MIGRATE_ON_START', '1') == '1'
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_BULK_USERS = 200
+MAX_SEARCH_OFFSET = 1000
+DB_POOL_SIZE = int(os.environ.get('CHAT_DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('CHAT_DB_POOL_TIMEOUT', 5))
+# Native threads that run SQLite calls in eventlet/gevent mode
+DB_THREADS = int(os.environ.get('CHAT_DB_THREADS', 8))
+# Conversations whose member lists are cached, and for how long (seconds)
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get('CHAT_MEMBERSHIP_CACHE_SIZE', 10000))
+MEMBERSHIP_CACHE_TTL = float(os.environ.get('CHAT_MEMBERSHIP_CACHE_TTL', 60))
+# How often (seconds) the user cache checks whether users has changed
+USER_VERSION_CHECK_INTERVAL = float(os.environ.get('CHAT_USER_VERSION_CHECK_INTERVAL', 1))
+# Messages committed per group transaction (0 commits each one on its own) and
+# how long a batch waits for more messages (0: only those already queued)
+INGEST_BATCH = int(os.environ.get('CHAT_INGEST_BATCH', 64))
+INGEST_DELAY_MS = float(os.environ.get('CHAT_INGEST_DELAY_MS', 0))
+# Read positions are buffered and written every this many ms, so opening a
+# conversation never waits for the write lock; 0 writes them in the request
+READ_FLUSH_MS = float(os.environ.get('CHAT_READ_FLUSH_MS', 200))
+# Shares Socket.IO room fan-out between worker processes (see mq.py)
+MESSAGE_QUEUE = os.environ.get('CHAT_MESSAGE_QUEUE')
+# ETag/Last-Modified validators carry a per-process token and this process's
+# buffered reads, so a tag only matches on the worker that issued it; they are
+# turned off when several workers share a message queue
+CONDITIONAL_GETS = not MESSAGE_QUEUE
+# REST bodies at least this large are gzip/brotli-compressed when the client
+# accepts it
+COMPRESS_MIN_SIZE = int(os.environ.get('CHAT_COMPRESS_MIN_SIZE', 1024))
+# Socket.IO packet encoding for all clients: 'default' (JSON) or 'msgpack'
+# (needs the msgpack package and socket.io-msgpack-parser on the client)
+SOCKETIO_SERIALIZER = os.environ.get('CHAT_SOCKETIO_SERIALIZER', 'default')
+HOST = os.environ.get('CHAT_HOST', '127.0.0.1')
+PORT = int(os.environ.get('CHAT_PORT', 5000))
+DEBUG = os.environ.get('CHAT_DEBUG', '1' if ASYNC_MODE == 'threading' else '0') == '1'
+# Statements slower than this many ms are logged with their query plan (0
+# turns the slow-query log off), as JSON lines appended to CHAT_SLOW_QUERY_LOG
+# or printed when it is unset
+SLOW_QUERY_MS = float(os.environ.get('CHAT_SLOW_QUERY_MS', 100))
+SLOW_QUERY_LOG = os.environ.get('CHAT_SLOW_QUERY_LOG')
+# /debug/profile shows SQL text and timings, so it is only served on request
+DEBUG_ENDPOINTS = os.environ.get('CHAT_DEBUG_ENDPOINTS', '1' if DEBUG else '0') == '1'
+
+if READ_MODEL not in ('receipts', 'watermark'):
+    raise ValueError(f"CHAT_READ_MODEL must be 'receipts' or 'watermark', not {READ_MODEL!r}")
+
+pool = ConnectionPool(DB, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+                      profile=DB_PROFILE,
+                      offload=thread_offloader(ASYNC_MODE, DB_THREADS))
+
+# Call memberships.invalidate(conversation_id) after changing conversation_members
+memberships = MembershipCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL)
+# User profiles; reloaded when the users_version counter changes
+directory = UserDirectory(USER_VERSION_CHECK_INTERVAL)
+# Change counters for conditional GETs: ('user', id) covers GET /conversations
+# for that user, ('conversation', id) covers its member list. Committed
+# changes bump the database's change_counters (migration 0007); these
+# in-process ones only cover reads still buffered in read_buffer.
+versions = VersionCounters()
+
+# Served on /metrics; gauges are refreshed there, everything else as it happens
+registry = Registry()
+http_latency = registry.histogram(
+    'chat_http_request_duration_seconds', 'REST request latency',
+    ('method', 'endpoint', 'status'))
+http_sql_statements = registry.histogram(
+    'chat_http_request_sql_statements', 'SQL statements run by one REST request',
+    ('endpoint',), COUNT_BUCKETS)
+http_sql_seconds = registry.histogram(
+    'chat_http_request_sql_seconds', 'Time one REST request spent in SQLite',
+    ('endpoint',))
+event_latency = registry.histogram(
+    'chat_socketio_event_duration_seconds', 'Socket.IO event handler latency',
+    ('event', 'outcome'))
+event_sql_statements = registry.histogram(
+    'chat_socketio_event_sql_statements', 'SQL statements run by one Socket.IO event',
+    ('event',), COUNT_BUCKETS)
+event_sql_seconds = registry.histogram(
+    'chat_socketio_event_sql_seconds', 'Time one Socket.IO event spent in SQLite',
+    ('event',))
+sql_statements_total = registry.counter(
+    'chat_sql_statements_total', 'SQL statements run, including background writes')
+sql_seconds_total = registry.counter(
+    'chat_sql_seconds_total', 'Time spent in SQLite, including background writes')
+socket_connections = registry.gauge(
+    'chat_socketio_connections', 'Socket.IO clients connected to this process')
+socket_rooms = registry.gauge(
+    'chat_socketio_rooms', 'Conversation and user rooms with a client in this process')
+room_sizes = registry.histogram(
+    'chat_socketio_room_size', 'Clients per room in this process', (), COUNT_BUCKETS)
+pool_gauge = registry.gauge(
+    'chat_db_pool', 'Connection pool statistics (see the health check)', ('stat',))
+ingest_gauge = registry.gauge(
+    'chat_ingest', 'Group commit statistics (see the health check)', ('stat',))
+read_buffer_gauge = registry.gauge(
+    'chat_read_buffer', 'Buffered read receipt statistics (see the health check)', ('stat',))
+cache_gauge = registry.gauge(
+    'chat_cache', 'In-process cache statistics', ('cache', 'stat'))
+
+def record_query(trace, seconds, rows):
+    """Pool hook: charge SQL work to the request or socket event running it"""
+    statements = 1 if trace.calls == 1 else 0
+    sql_statements_total.inc(statements)
+    sql_seconds_total.inc(seconds)
+    if has_app_context() and 'sql_usage' in g:
+        g.sql_usage[0] += statements
+        g.sql_usage[1] += seconds
+
+pool.on_query.append(record_query)
+
+def query_context():
+    """What a slow statement was run for: a route, a socket event or neither"""
+    if not has_request_context():
+        return 'background'
+    event = getattr(request, 'event', None)
+    if event:
+        return f"socket {event['message']}"
+    return f'{request.method} {request.path}'
+
+def log_slow_query(entry):
+    line = json.dumps(entry)
+    if SLOW_QUERY_LOG:
+        with open(SLOW_QUERY_LOG, 'a') as f:
+            f.write(line + '\n')
+    else:
+        print(f'Slow query: {line}')
+
+# Per-statement totals for /debug/profile, plus the slow-query log
+profiler = QueryProfiler(DB, SLOW_QUERY_MS / 1000, log=log_slow_query, context=query_context)
+pool.on_query.append(profiler)
 
 def get_db():
-    conn = sqlite3.connect(DB)
-    conn.row_factory = sqlite3.Row
-    conn.execute('PRAGMA foreign_keys = ON')
-    return conn
+    """Check out one pooled connection per request/socket event"""
+    if 'db' not in g:
+        g.db = pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        pool.release(conn)
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+    g.sql_usage = [0, 0.0]
+
+# Registered before compress_response so that it runs after it (Flask runs
+# after_request functions in reverse order) and the timing includes compression
+@app.after_request
+def record_request(response):
+    if 'started' in g:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_latency.observe(time.perf_counter() - g.started, method=request.method,
+                             endpoint=endpoint, status=response.status_code)
+        http_sql_statements.observe(g.sql_usage[0], endpoint=endpoint)
+        http_sql_seconds.observe(g.sql_usage[1], endpoint=endpoint)
+    return response
+
+@app.after_request
+def compress_response(response):
+    return wire.compress(response, request, COMPRESS_MIN_SIZE)
 
 def init_db():
-    """Initialize database from SQL file if it doesn't exist"""
+    """Initialize database from SQL file if it doesn't exist, then apply any
+    pending schema migrations"""
     if not os.path.exists(DB):
         print("Database not found! Creating new database...")
         
@@ -47,6 +236,285 @@ def init_db():
     else:
         print("Database already exists!")
 
+    if MIGRATE_ON_START:
+        conn = sqlite3.connect(DB)
+        try:
+            applied = migrate.apply(conn)
+            print(f"{len(applied)} migration(s) applied")
+        except Exception as e:
+            print(f"Error applying migrations: {e}")
+            print("Fix the error and run: python3 manage.py migrate")
+            exit(1)
+        finally:
+            conn.close()
+
+
+def bump_unread(conn, conversation_id, sender_id):
+    """Count a new message as unread for every member except its sender"""
+    conn.execute('''
+        INSERT INTO conversation_unread (user_id, conversation_id, count)
+        SELECT user_id, conversation_id, 1 FROM conversation_members
+        WHERE conversation_id = ? AND user_id != ?
+        ON CONFLICT (user_id, conversation_id) DO UPDATE SET count = count + 1
+    ''', (conversation_id, sender_id))
+
+def store_message(conn, conversation_id, sender_id, content):
+    """Insert a message from a conversation member (without committing).
+    Returns the stored message, or None if sender_id is not a member."""
+    if not memberships.is_member(conn, conversation_id, parse_user_id(sender_id)):
+        return None
+
+    cursor = conn.execute(
+        '''INSERT INTO messages (conversation_id, sender_id, content)
+           VALUES (?, ?, ?)''',
+        (conversation_id, sender_id, content)
+    )
+    new_id = cursor.lastrowid
+    bump_unread(conn, conversation_id, sender_id)
+
+    message = dict(conn.execute('''
+        SELECT m.*, 0 as is_read FROM messages m WHERE m.id = ?
+    ''', (new_id,)).fetchone())
+    return directory.attach_sender_names(conn, [message])[0]
+
+def broadcast_message(message):
+    """Send a committed message, and the unread change it causes, to its room"""
+    conversation_id = message['conversation_id']
+    socketio.emit('new_message', message, room=conversation_id)
+    # One event for the whole room; the sender's own count is unchanged
+    socketio.emit('unread_changed', {
+        'conversation_id': conversation_id,
+        'delta': 1,
+        'sender_id': message['sender_id']
+    }, room=conversation_id)
+
+def broadcast_messages(messages):
+    for message in messages:
+        if message is not None:
+            broadcast_message(message)
+
+def parse_user_id(value):
+    """A user id from a request (an int, or a string of digits) as an int, or
+    None. Bools and floats are refused rather than coerced, so ``true`` or
+    ``1.9`` never act as user 1."""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    if not str(value).isdigit():
+        return None
+    return int(value)
+
+def message_fields_error(conversation_id, sender_id, content):
+    """Why a message cannot be stored as given, or None. Checked before the
+    message is queued for the group commit, so a malformed one is refused on
+    its own."""
+    if not isinstance(conversation_id, str) or not conversation_id:
+        return 'conversation_id must be a non-empty string'
+    if parse_user_id(sender_id) is None:
+        return 'sender_id must be a user id'
+    if not isinstance(content, str) or not content.strip():
+        return 'Message cannot be empty'
+    return None
+
+def post_message(conversation_id, sender_id, content):
+    """Store a message from a conversation member and broadcast it once it is
+    committed. Returns the stored message, or None if sender_id is not a
+    member."""
+    error = message_fields_error(conversation_id, sender_id, content)
+    if error:
+        raise ValueError(error)
+    if ingest is not None:
+        return ingest.submit((conversation_id, sender_id, content))
+
+    conn = get_db()
+    message = store_message(conn, conversation_id, sender_id, content)
+    if message is not None:
+        conn.commit()
+        broadcast_message(message)
+    return message
+
+def cache_validators(conn, key):
+    """(etag, last_modified) for a response built from version ``key`` and
+    user profiles, or None when conditional GETs are off. The database's
+    change_counters row for the key covers every committed change, whoever
+    made it; the in-process counter covers reads still in read_buffer."""
+    if not CONDITIONAL_GETS:
+        return None
+    scope, key_id = key
+    row = conn.execute('''
+        SELECT version, changed_at FROM change_counters WHERE scope = ? AND key = ?
+    ''', (scope, str(key_id))).fetchone()
+    stored, changed_at = (row['version'], row['changed_at']) if row else (0, 0.0)
+    version, modified = versions.get(key)
+    etag = f'{versions.epoch}-{version}-{stored}-{directory.version(conn)}'
+    if wire.wants_msgpack(request):
+        etag += '-msgpack'
+    return etag, max(modified, changed_at, directory.changed_at)
+
+def not_modified(validators):
+    """True if the client's copy (If-None-Match / If-Modified-Since) is current"""
+    if validators is None:
+        return False
+    etag, modified = validators
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and int(modified) <= since.timestamp()
+
+def with_validators(response, validators):
+    if validators is not None:
+        etag, modified = validators
+        response.set_etag(etag, weak=True)
+        # Whole seconds cannot tell apart two versions from the same second,
+        # so only send a date that has fully passed
+        if int(modified) < int(time.time()):
+            response.last_modified = modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def user_room(user_id):
+    """Socket.IO room holding every session of one user"""
+    return f'user:{int(user_id)}'
+
+def announce_read(conversation_id, user_id):
+    """Tell the reader's sessions that a conversation has no unread messages"""
+    versions.bump(('user', int(user_id)))
+    socketio.emit('unread_changed', {
+        'conversation_id': conversation_id,
+        'unread_count': 0
+    }, room=user_room(user_id))
+
+def broadcast_read_receipts(reads):
+    """Tell each conversation how far a reader has read, one event per
+    ((user_id, conversation_id), last read message id) pair, so senders can
+    show their messages as seen"""
+    for (user_id, conversation_id), last_read_id in reads:
+        socketio.emit('read_receipt', {
+            'conversation_id': conversation_id,
+            'user_id': user_id,
+            'last_read_message_id': last_read_id
+        }, room=conversation_id)
+
+def write_read(conn, key, last_read_id):
+    """Apply one reader's position (key is (user_id, conversation_id)): mark
+    everything up to last_read_id read and recount the reader's unread
+    messages above it (messages may have arrived since the read was
+    buffered)"""
+    user_id, conversation_id = key
+    if READ_MODEL == 'watermark':
+        conn.execute('''
+            UPDATE conversation_members SET last_read_message_id = ?
+            WHERE conversation_id = ? AND user_id = ? AND last_read_message_id < ?
+        ''', (last_read_id, conversation_id, user_id, last_read_id))
+    else:
+        conn.execute('''
+            INSERT OR IGNORE INTO message_reads (message_id, user_id)
+            SELECT m.id, ? FROM messages m
+            LEFT JOIN message_reads mr ON m.id = mr.message_id AND mr.user_id = ?
+            WHERE m.conversation_id = ? AND m.id <= ?
+              AND mr.message_id IS NULL AND m.sender_id != ?
+        ''', (user_id, user_id, conversation_id, last_read_id, user_id))
+
+    conn.execute('''
+        INSERT INTO conversation_unread (user_id, conversation_id, count, last_read_message_id)
+        VALUES (:user_id, :conv_id, (
+            SELECT COUNT(*) FROM messages
+            WHERE conversation_id = :conv_id AND id > :last_read_id AND sender_id != :user_id
+        ), :last_read_id)
+        ON CONFLICT (user_id, conversation_id) DO UPDATE
+        SET count = excluded.count, last_read_message_id = excluded.last_read_message_id
+        WHERE last_read_message_id <= excluded.last_read_message_id
+    ''', {'user_id': user_id, 'conv_id': conversation_id, 'last_read_id': last_read_id})
+
+def pending_read(user_id, conversation_id):
+    """Last read message id buffered for a reader but not yet written, or None"""
+    if read_buffer is None:
+        return None
+    return read_buffer.get((int(user_id), conversation_id))
+
+def pending_reads(user_id):
+    """{conversation_id: last read message id} buffered for a reader"""
+    if read_buffer is None:
+        return {}
+    return {conv_id: last_read_id for (reader, conv_id), last_read_id in read_buffer.items()
+            if reader == user_id}
+
+def mark_conversation_read(conn, conversation_id, user_id):
+    """Mark every message in a conversation read for user_id. The write is
+    buffered (see read_buffer) unless CHAT_READ_FLUSH_MS is 0, in which case
+    the caller commits it and then broadcasts the read receipt. Returns the
+    number of messages from others that were unread until now and the id
+    read up to."""
+    user_id = int(user_id)
+    row = conn.execute('''
+        SELECT (SELECT COALESCE(MAX(id), 0) FROM messages
+                WHERE conversation_id = :conv_id) as latest_id,
+               COALESCE(:pending, (SELECT last_read_message_id FROM conversation_unread
+                                   WHERE user_id = :user_id AND conversation_id = :conv_id),
+                        0) as last_read_id
+    ''', {'conv_id': conversation_id, 'user_id': user_id,
+          'pending': pending_read(user_id, conversation_id)}).fetchone()
+    latest_id, last_read_id = row['latest_id'], row['last_read_id']
+    if latest_id <= last_read_id:
+        return 0, last_read_id
+
+    marked_count = conn.execute('''
+        SELECT COUNT(*) FROM messages
+        WHERE conversation_id = ? AND id > ? AND id <= ? AND sender_id != ?
+    ''', (conversation_id, last_read_id, latest_id, user_id)).fetchone()[0]
+    if read_buffer is not None:
+        read_buffer.put((user_id, conversation_id), latest_id)
+    else:
+        write_read(conn, (user_id, conversation_id), latest_id)
+    return marked_count, latest_id
+
+def attach_read_counts(conn, conversation_id, messages):
+    """Set read_count (members other than the sender who have read it) on
+    message dicts from one conversation. The receipts model selects it with
+    the message (messages.read_count, kept by triggers on message_reads); the
+    watermark model counts member watermarks at or past each message, read
+    with one query per page."""
+    if READ_MODEL != 'watermark' or not messages:
+        return messages
+    watermarks = dict(conn.execute('''
+        SELECT user_id, last_read_message_id FROM conversation_members
+        WHERE conversation_id = ?
+    ''', (conversation_id,)).fetchall())
+    ordered = sorted(watermarks.values())
+    for message in messages:
+        read_count = len(ordered) - bisect.bisect_left(ordered, message['id'])
+        if watermarks.get(message['sender_id'], 0) >= message['id']:
+            read_count -= 1
+        message['read_count'] = read_count
+    return messages
+
+# is_read for the requesting user under each read model. Both produce the same
+# value (own messages are never "read" by their sender), so responses keep the
+# same shape whichever model is active.
+READ_STATUS_SQL = {
+    'receipts': (
+        'CASE WHEN mr.user_id IS NOT NULL THEN 1 ELSE 0 END',
+        'LEFT JOIN message_reads mr ON m.id = mr.message_id AND mr.user_id = :user_id',
+    ),
+    'watermark': (
+        'CASE WHEN m.sender_id != :user_id AND m.id <= cm.last_read_message_id '
+        'THEN 1 ELSE 0 END',
+        'JOIN conversation_members cm '
+        'ON cm.conversation_id = m.conversation_id AND cm.user_id = :user_id',
+    ),
+}
+
+
+# Markers snippet() puts around matches; swapped for <mark> after escaping
+HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE = '\x02', '\x03'
+
+def fts_query(text):
+    """Turn free text into an FTS5 query matching every word, the last one as
+    a prefix so results appear while typing. Quoting each word keeps FTS5
+    operators and punctuation in user input from being parsed as syntax."""
+    words = [w.replace('"', '""') for w in text.split()]
+    if not words:
+        return None
+    return ' '.join(f'"{w}"' for w in words) + '*'
 
 # API 1: List conversations with unread counts
 @app.route('/conversations', methods=['GET'])
@@ -57,47 +525,52 @@ def list_conversations():
             return jsonify({'error': 'Invalid or missing user_id'}), 400
         user_id = int(user_id)
         conn = get_db()
+        validators = cache_validators(conn, ('user', user_id))
+        if not_modified(validators):
+            return with_validators(app.response_class(status=304), validators)
         
-        # Get all conversations for this user
+        # Taken before the query: a read flushed in between is then either
+        # overlaid here or already visible to the query
+        pending = pending_reads(user_id)
+
+        # Get all conversations for this user in one statement; unread counts
+        # come from the materialized conversation_unread table and direct chats
+        # are named after the other participant
         cursor = conn.execute('''
-            SELECT DISTINCT c.id, c.name, c.type,
-                   COALESCE(unread.unread_count, 0) as unread_count,
+            SELECT c.id, c.type,
+                   CASE WHEN c.type = 'direct' THEN COALESCE(
+                       (SELECT u.name FROM conversation_members other
+                        JOIN users u ON u.id = other.user_id
+                        WHERE other.conversation_id = c.id AND other.user_id != cm.user_id
+                        LIMIT 1), c.name)
+                   ELSE c.name END as name,
+                   COALESCE(cu.count, 0) as unread_count,
                    (SELECT COUNT(*) FROM conversation_members cm2 
                     WHERE cm2.conversation_id = c.id) as member_count
-            FROM conversations c
-            JOIN conversation_members cm ON c.id = cm.conversation_id
-            LEFT JOIN (
-                SELECT m.conversation_id, COUNT(*) as unread_count
-                FROM messages m
-                LEFT JOIN message_reads mr ON m.id = mr.message_id AND mr.user_id = ?
-                WHERE mr.message_id IS NULL AND m.sender_id != ?
-                GROUP BY m.conversation_id
-            ) unread ON c.id = unread.conversation_id
+            FROM conversation_members cm
+            JOIN conversations c ON c.id = cm.conversation_id
+            LEFT JOIN conversation_unread cu
+                   ON cu.user_id = cm.user_id AND cu.conversation_id = cm.conversation_id
             WHERE cm.user_id = ?
-            ORDER BY unread.unread_count DESC, c.created_at DESC
-        ''', (user_id, user_id, user_id))
-        
-        convs = []
-        for row in cursor.fetchall():
-            conv = dict(row)
-            
-            # For direct chats, get the other user's name
-            if conv['type'] == 'direct':
-                other_user = conn.execute('''
-                    SELECT u.name FROM users u
-                    JOIN conversation_members cm ON u.id = cm.user_id
-                    WHERE cm.conversation_id = ? 
-                    AND cm.user_id != ?
-                    LIMIT 1
-                ''', (conv['id'], user_id)).fetchone()
-                
-                if other_user:
-                    conv['name'] = other_user['name']
-            
-            convs.append(conv)
+            ORDER BY unread_count DESC, c.created_at DESC
+        ''', (user_id,))
         
-        conn.close()
-        return jsonify(convs)
+        convs = [dict(row) for row in cursor.fetchall()]
+        if pending:
+            # Unread counts past the buffered reads, for all of them in one
+            # statement so the endpoint's cost stays constant
+            recounted = dict(conn.execute('''
+                SELECT p.key, (SELECT COUNT(*) FROM messages m
+                               WHERE m.conversation_id = p.key AND m.id > p.value
+                                 AND m.sender_id != ?)
+                FROM json_each(?) p
+            ''', (user_id, json.dumps(pending))).fetchall())
+            for conv in convs:
+                if conv['id'] in recounted:
+                    conv['unread_count'] = recounted[conv['id']]
+            # Stable, so conversations keep their created_at order within a count
+            convs.sort(key=lambda conv: -conv['unread_count'])
+        return with_validators(jsonify(convs), validators)
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         return jsonify({'error': 'Database error'}), 500
@@ -105,51 +578,88 @@ def list_conversations():
         print(f"Server error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
     
-# API 2: Get messages (auto-mark read)
+# API 2: Get messages (auto-mark read), keyset-paginated by message id
 @app.route('/conversations/<conv_id>/messages', methods=['GET'])
 def get_messages(conv_id):
     user_id = request.args.get('user_id')
     if not user_id or not user_id.isdigit():
         return jsonify({'error': 'Invalid or missing user_id'}), 400
     user_id = int(user_id)
+
+    page = {}
+    for name in ('limit', 'before_id', 'after_id'):
+        value = request.args.get(name)
+        if value is not None:
+            if not value.isdigit():
+                return jsonify({'error': f'Invalid {name}'}), 400
+            page[name] = int(value)
+    if 'before_id' in page and 'after_id' in page:
+        return jsonify({'error': 'Use either before_id or after_id, not both'}), 400
+    limit = max(1, min(page.get('limit', DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
     
     try:
         conn = get_db()
         
         # Verify membership
-        member_check = conn.execute('''
-            SELECT 1 FROM conversation_members 
-            WHERE conversation_id = ? AND user_id = ?
-        ''', (conv_id, user_id)).fetchone()
-        
-        if not member_check:
-            conn.close()
+        if not memberships.is_member(conn, conv_id, user_id):
             return jsonify({'error': 'Unauthorized'}), 403
         
-        # Auto-mark unread messages as read
-        conn.execute('''
-            INSERT OR IGNORE INTO message_reads (message_id, user_id)
-            SELECT m.id, ? FROM messages m
-            LEFT JOIN message_reads mr ON m.id = mr.message_id AND mr.user_id = ?
-            WHERE m.conversation_id = ? AND mr.message_id IS NULL AND m.sender_id != ?
-        ''', (user_id, user_id, conv_id, user_id))
+        # Auto-mark unread messages as read; older pages were read already
+        marked_count = 0
+        if 'before_id' not in page:
+            marked_count, read_up_to = mark_conversation_read(conn, conv_id, user_id)
+        # Reads still buffered in read_buffer are not in the query's is_read.
+        # Taken before the query, as in list_conversations: a read flushed in
+        # between is then either overlaid below or already visible to the query
+        last_read_id = pending_read(user_id, conv_id)
         
-        # Fetch messages with sender names
-        cursor = conn.execute('''
-            SELECT m.*, u.name as sender_name,
-                   CASE WHEN mr.user_id IS NOT NULL THEN 1 ELSE 0 END as is_read
+        # Walk the (conversation_id, id) index from the cursor: newest-first for
+        # the latest page and before_id, oldest-first for after_id. One extra
+        # row tells us whether another page exists.
+        if 'after_id' in page:
+            bound, order, cursor_id = 'AND m.id > :cursor_id', 'ASC', page['after_id']
+        elif 'before_id' in page:
+            bound, order, cursor_id = 'AND m.id < :cursor_id', 'DESC', page['before_id']
+        else:
+            bound, order, cursor_id = '', 'DESC', None
+
+        # Fetch messages; sender names come from the user directory
+        is_read, read_join = READ_STATUS_SQL[READ_MODEL]
+        cursor = conn.execute(f'''
+            SELECT m.*, {is_read} as is_read
             FROM messages m 
-            JOIN users u ON m.sender_id = u.id
-            LEFT JOIN message_reads mr ON m.id = mr.message_id AND mr.user_id = ?
-            WHERE m.conversation_id = ? 
-            ORDER BY m.created_at ASC
-            LIMIT 50
-        ''', (user_id, conv_id))
+            {read_join}
+            WHERE m.conversation_id = :conv_id {bound}
+            ORDER BY m.id {order}
+            LIMIT :limit
+        ''', {'user_id': user_id, 'conv_id': conv_id, 'cursor_id': cursor_id,
+              'limit': limit + 1})
         
-        msgs = [dict(row) for row in cursor.fetchall()]
+        msgs = directory.attach_sender_names(conn, [dict(row) for row in cursor.fetchall()])
+        attach_read_counts(conn, conv_id, msgs)
+        if last_read_id is not None:
+            for msg in msgs:
+                if msg['sender_id'] != user_id and msg['id'] <= last_read_id:
+                    msg['is_read'] = 1
         conn.commit()
-        conn.close()
-        return jsonify(msgs)
+        if marked_count:
+            announce_read(conv_id, user_id)
+            if read_buffer is None:
+                broadcast_read_receipts([((int(user_id), conv_id), read_up_to)])
+
+        has_more = len(msgs) > limit
+        msgs = msgs[:limit]
+        if order == 'DESC':
+            msgs.reverse()
+
+        return jsonify({
+            'messages': msgs,
+            'has_more': has_more,
+            # Pass as before_id to load older messages (null at the start)
+            'next_before_id': msgs[0]['id'] if msgs and has_more and order == 'DESC' else None,
+            # Pass as after_id to load messages newer than this page
+            'next_after_id': msgs[-1]['id'] if msgs else cursor_id if order == 'ASC' else None
+        })
         
     except sqlite3.Error as e:
         return jsonify({'error': 'Database error'}), 500
@@ -161,24 +671,20 @@ def get_messages(conv_id):
 def send_message():
     try:
         data = request.json
-        if not data.get('content', '').strip():
-            return jsonify({'error': 'Message cannot be empty'}), 400
-        
-        conn = get_db()
-        cursor = conn.execute(
-            '''INSERT INTO messages (conversation_id, sender_id, content) 
-               VALUES (?, ?, ?)''',
-            (data['conversation_id'], data['sender_id'], data['content'])
-        )
+        error = message_fields_error(data['conversation_id'], data['sender_id'],
+                                     data.get('content'))
+        if error:
+            return jsonify({'error': error}), 400
         
-        new_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        message = post_message(data['conversation_id'], data['sender_id'], data['content'])
+        if message is None:
+            return jsonify({'error': 'Unauthorized'}), 403
         
         return jsonify({
-            'id': new_id, 
+            'id': message['id'], 
             'success': True,
-            'message': 'Message sent!'
+            'message': 'Message sent!',
+            'data': message
         }), 201
         
     except sqlite3.Error as e:
@@ -193,34 +699,24 @@ def send_message():
 def mark_as_read(conv_id):
     try:
         data = request.json
-        user_id = data.get('user_id')
+        user_id = parse_user_id(data.get('user_id'))
         
-        if not user_id:
-            return jsonify({'error': 'Missing user_id'}), 400
+        if user_id is None:
+            return jsonify({'error': 'Invalid or missing user_id'}), 400
         
         conn = get_db()
         
         # Verify membership
-        member_check = conn.execute('''
-            SELECT 1 FROM conversation_members 
-            WHERE conversation_id = ? AND user_id = ?
-        ''', (conv_id, user_id)).fetchone()
-        
-        if not member_check:
-            conn.close()
+        if not memberships.is_member(conn, conv_id, user_id):
             return jsonify({'error': 'Unauthorized'}), 403
         
         # Mark all unread messages as read
-        cursor = conn.execute('''
-            INSERT OR IGNORE INTO message_reads (message_id, user_id)
-            SELECT m.id, ? FROM messages m
-            LEFT JOIN message_reads mr ON m.id = mr.message_id AND mr.user_id = ?
-            WHERE m.conversation_id = ? AND mr.message_id IS NULL AND m.sender_id != ?
-        ''', (user_id, user_id, conv_id, user_id))
-        
-        marked_count = cursor.rowcount
+        marked_count, read_up_to = mark_conversation_read(conn, conv_id, user_id)
         conn.commit()
-        conn.close()
+        if marked_count:
+            announce_read(conv_id, user_id)
+            if read_buffer is None:
+                broadcast_read_receipts([((user_id, conv_id), read_up_to)])
         
         return jsonify({
             'success': True,
@@ -232,15 +728,82 @@ def mark_as_read(conv_id):
     except Exception as e:
         return jsonify({'error': 'Internal server error'}), 500
 
+# API 4b: Who has read a message
+@app.route('/messages/<int:message_id>/reads', methods=['GET'])
+def get_message_reads(message_id):
+    user_id = request.args.get('user_id')
+    if not user_id or not user_id.isdigit():
+        return jsonify({'error': 'Invalid or missing user_id'}), 400
+    user_id = int(user_id)
+
+    try:
+        conn = get_db()
+        message = conn.execute('''
+            SELECT conversation_id, sender_id FROM messages WHERE id = ?
+        ''', (message_id,)).fetchone()
+        if message is None:
+            return jsonify({'error': 'Message not found'}), 404
+        conv_id = message['conversation_id']
+        if not memberships.is_member(conn, conv_id, user_id):
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        if READ_MODEL == 'watermark':
+            # A watermark does not record when it moved, so read_at is null
+            reads = conn.execute('''
+                SELECT user_id, NULL as read_at FROM conversation_members
+                WHERE conversation_id = ? AND last_read_message_id >= ? AND user_id != ?
+            ''', (conv_id, message_id, message['sender_id'])).fetchall()
+        else:
+            reads = conn.execute('''
+                SELECT user_id, read_at FROM message_reads WHERE message_id = ?
+            ''', (message_id,)).fetchall()
+
+        users = directory.get_many(conn, [row['user_id'] for row in reads])
+        readers = [{
+            'user_id': row['user_id'],
+            'name': users[row['user_id']]['name'] if row['user_id'] in users else None,
+            'read_at': row['read_at']
+        } for row in reads]
+        readers.sort(key=lambda reader: (reader['read_at'] or '', reader['user_id']))
+
+        return jsonify({
+            'message_id': message_id,
+            'conversation_id': conv_id,
+            'read_count': len(readers),
+            'readers': readers
+        })
+    except sqlite3.Error as e:
+        return jsonify({'error': 'Database error'}), 500
+    except Exception as e:
+        return jsonify({'error': 'Internal server error'}), 500
+
 # API 5: Get user info
 @app.route('/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
     try:
-        conn = get_db()
-        cursor = conn.execute('SELECT id, name, avatar FROM users WHERE id = ?', (user_id,))
-        user = cursor.fetchone()
-        conn.close()
-        return jsonify(dict(user)) if user else (jsonify({'error': 'User not found'}), 404)
+        user = directory.get(get_db(), user_id)
+        return jsonify(user) if user else (jsonify({'error': 'User not found'}), 404)
+    except sqlite3.Error as e:
+        return jsonify({'error': 'Database error'}), 500
+    except Exception as e:
+        return jsonify({'error': 'Internal server error'}), 500
+
+# API 5b: Get several users at once
+@app.route('/users', methods=['GET'])
+def get_users():
+    ids = request.args.get('ids', '')
+    try:
+        user_ids = [int(i) for i in ids.split(',') if i.strip()]
+    except ValueError:
+        return jsonify({'error': 'ids must be a comma-separated list of user ids'}), 400
+    if not user_ids:
+        return jsonify({'error': 'Missing ids'}), 400
+    if len(user_ids) > MAX_BULK_USERS:
+        return jsonify({'error': f'At most {MAX_BULK_USERS} ids per request'}), 400
+
+    try:
+        users = directory.get_many(get_db(), user_ids)
+        return jsonify([users[user_id] for user_id in dict.fromkeys(user_ids) if user_id in users])
     except sqlite3.Error as e:
         return jsonify({'error': 'Database error'}), 500
     except Exception as e:
@@ -251,32 +814,204 @@ def get_user(user_id):
 def get_members(conv_id):
     try:
         conn = get_db()
-        cursor = conn.execute('''
-            SELECT u.id, u.name, u.avatar 
-            FROM users u
-            JOIN conversation_members cm ON u.id = cm.user_id
-            WHERE cm.conversation_id = ?
-        ''', (conv_id,))
-        members = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return jsonify(members)
+        validators = cache_validators(conn, ('conversation', conv_id))
+        if not_modified(validators):
+            return with_validators(app.response_class(status=304), validators)
+        # Read from the table, not the membership cache: the body must be as
+        # current as the change_counters version in its ETag
+        member_ids = [row[0] for row in conn.execute('''
+            SELECT user_id FROM conversation_members WHERE conversation_id = ?
+        ''', (conv_id,))]
+        users = directory.get_many(conn, member_ids)
+        return with_validators(jsonify([users[user_id] for user_id in sorted(users)]),
+                               validators)
     except sqlite3.Error as e:
         return jsonify({'error': 'Database error'}), 500
     except Exception as e:
         return jsonify({'error': 'Internal server error'}), 500
 
+# API 7: Full-text search over the user's conversations, best matches first
+@app.route('/search', methods=['GET'])
+def search_messages():
+    user_id = request.args.get('user_id')
+    if not user_id or not user_id.isdigit():
+        return jsonify({'error': 'Invalid or missing user_id'}), 400
+    user_id = int(user_id)
+    match = fts_query(request.args.get('q', ''))
+    if not match:
+        return jsonify({'error': 'Missing search query'}), 400
+
+    page = {}
+    for name in ('limit', 'offset'):
+        value = request.args.get(name)
+        if value is not None:
+            if not value.isdigit():
+                return jsonify({'error': f'Invalid {name}'}), 400
+            page[name] = int(value)
+    limit = max(1, min(page.get('limit', DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+    offset = page.get('offset', 0)
+    if offset > MAX_SEARCH_OFFSET:
+        return jsonify({'error': f'offset may not exceed {MAX_SEARCH_OFFSET}'}), 400
+    conv_id = request.args.get('conversation_id')
+
+    try:
+        conn = get_db()
+        if conv_id is not None:
+            if not memberships.is_member(conn, conv_id, user_id):
+                return jsonify({'error': 'Unauthorized'}), 403
+            scope = 'm.conversation_id = :conv_id'
+        else:
+            scope = '''m.conversation_id IN (
+                SELECT conversation_id FROM conversation_members WHERE user_id = :user_id)'''
+
+        # rank is FTS5's bm25() score; lower is better
+        cursor = conn.execute(f'''
+            SELECT m.id, m.conversation_id, m.sender_id, m.content, m.created_at,
+                   snippet(messages_fts, 0, :open, :close, '…', 24) as highlight
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH :match AND {scope}
+            ORDER BY rank
+            LIMIT :limit OFFSET :offset
+        ''', {'match': match, 'user_id': user_id, 'conv_id': conv_id,
+              'open': HIGHLIGHT_OPEN, 'close': HIGHLIGHT_CLOSE,
+              'limit': limit + 1, 'offset': offset})
+        results = directory.attach_sender_names(conn, [dict(row) for row in cursor.fetchall()])
+
+        has_more = len(results) > limit
+        results = results[:limit]
+        for result in results:
+            result['highlight'] = (html.escape(result['highlight'])
+                                   .replace(HIGHLIGHT_OPEN, '<mark>')
+                                   .replace(HIGHLIGHT_CLOSE, '</mark>'))
+
+        return jsonify({
+            'results': results,
+            'has_more': has_more,
+            'next_offset': offset + limit if has_more and offset + limit <= MAX_SEARCH_OFFSET else None
+        })
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        return jsonify({'error': 'Database error'}), 500
+    except Exception as e:
+        print(f"Server error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 # Health check
 @app.route('/', methods=['GET'])
 def health():
+    # A real round trip: pool checkout plus a query against the schema
+    started = time.perf_counter()
+    try:
+        schema_version = get_db().execute(
+            'SELECT MAX(version) FROM schema_version'
+        ).fetchone()[0]
+        database = {'status': 'Connected', 'schema_version': schema_version}
+    except sqlite3.Error as e:
+        database = {'status': 'Unavailable', 'error': str(e)}
+    database['latency_ms'] = round((time.perf_counter() - started) * 1000, 3)
+
     return jsonify({
         'status': 'Chat API running!',
         'features': ['Multi-user', 'Groups', 'Read receipts'],
-        'database': 'Connected'
-    })
+        'database': database,
+        'pool': pool.stats(),
+        'ingest': ingest.stats() if ingest is not None else None,
+        'read_buffer': read_buffer.stats() if read_buffer is not None else None,
+        'membership_cache': memberships.stats(),
+        'user_directory': directory.stats()
+    }), 200 if database['status'] == 'Connected' else 503
+
+# Prometheus metrics for this process
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    for name, value in pool.stats().items():
+        if name != 'profile':
+            pool_gauge.set(value, stat=name)
+    if ingest is not None:
+        for name, value in ingest.stats().items():
+            ingest_gauge.set(value, stat=name)
+    if read_buffer is not None:
+        for name, value in read_buffer.stats().items():
+            read_buffer_gauge.set(value, stat=name)
+    for cache, stats in (('membership', memberships.stats()),
+                         ('user_directory', directory.stats())):
+        for name, value in stats.items():
+            if value is not None:
+                cache_gauge.set(value, cache=cache, stat=name)
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+    # manager.rooms maps room -> clients; every client also sits in the None
+    # room and in a private room named after its sid, which are not counted
+    rooms = dict(socketio.server.manager.rooms.get('/', {}))
+    clients = rooms.pop(None, {})
+    sizes = [len(members) for room, members in rooms.items() if room not in clients]
+    socket_connections.set(len(clients))
+    socket_rooms.set(len(sizes))
+    room_sizes.set_all(sizes)
 
-@socketio.on('authenticate')
+    return app.response_class(registry.render(),
+                              content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# SQL profile: statements ranked by total time since startup (or the last
+# reset), with their query plans and the most recent slow ones
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    if not DEBUG_ENDPOINTS:
+        return jsonify({'error': 'Not found'}), 404
+    order = request.args.get('order', 'seconds')
+    if order not in ('seconds', 'calls', 'max_seconds', 'rows'):
+        return jsonify({'error': 'order must be seconds, calls, max_seconds or rows'}), 400
+    limit = request.args.get('limit', '20')
+    if not limit.isdigit():
+        return jsonify({'error': 'Invalid limit'}), 400
+    report = profiler.report(int(limit), order)
+    if request.args.get('reset') == '1':
+        profiler.reset()
+    return jsonify(report)
+
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE,
+                    serializer=SOCKETIO_SERIALIZER, **mq.socketio_options(MESSAGE_QUEUE))
+
+# Sent messages are written by one background writer that commits them in
+# groups, so concurrent senders share a transaction (and its fsync)
+ingest = GroupCommitter(
+    pool, lambda conn, item: store_message(conn, *item),
+    on_commit=broadcast_messages, max_batch=INGEST_BATCH,
+    max_delay=INGEST_DELAY_MS / 1000, spawn=socketio.start_background_task
+) if INGEST_BATCH > 0 else None
+
+# Read positions from opening or marking a conversation, coalesced per reader
+# and conversation and written in one transaction per interval. Until then
+# the reader's own responses overlay them (see pending_read); the read
+# receipts go out once they are committed.
+read_buffer = WriteBehindBuffer(
+    pool, write_read, on_commit=broadcast_read_receipts, interval=READ_FLUSH_MS / 1000,
+    merge=max, spawn=socketio.start_background_task
+) if READ_FLUSH_MS > 0 else None
+
+def socket_event(name):
+    """socketio.on(name) that also records the handler's latency and SQL use.
+    The outcome is 'error' when the handler raises or acks success: False."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args):
+            started = time.perf_counter()
+            g.sql_usage = [0, 0.0]
+            outcome = 'error'
+            try:
+                result = handler(*args)
+                if not (isinstance(result, dict) and result.get('success') is False):
+                    outcome = 'ok'
+                return result
+            finally:
+                event_latency.observe(time.perf_counter() - started, event=name,
+                                      outcome=outcome)
+                event_sql_statements.observe(g.sql_usage[0], event=name)
+                event_sql_seconds.observe(g.sql_usage[1], event=name)
+        return socketio.on(name)(wrapper)
+    return decorator
+
+@socket_event('authenticate')
 def authenticate(data):
     """Join all user's conversations on authentication"""
     user_id = data.get('user_id')
@@ -290,78 +1025,47 @@ def authenticate(data):
             WHERE user_id = ?
         ''', (user_id,))
         conversations = cursor.fetchall()
-        conn.close()
         
         for conv in conversations:
             join_room(conv['conversation_id'])
+        join_room(user_room(user_id))
         
         emit('authenticated', {'success': True})
     except Exception as e:
         print(f"Authentication error: {e}")
         emit('error', {'message': 'Authentication failed'})
 
-@socketio.on('message')
+@socket_event('message')
 def handle_message(data):
     try:
-        if not data.get('content', '').strip():
-            return {'success': False, 'error': 'Empty message'}
-        
         conversation_id = data.get('conversation_id')
         sender_id = data.get('sender_id')
         
         if not conversation_id or not sender_id:
             return {'success': False, 'error': 'Missing fields'}
         
-        conn = get_db()
+        error = message_fields_error(conversation_id, sender_id, data.get('content'))
+        if error:
+            return {'success': False, 'error': error}
         
-        member_check = conn.execute('''
-            SELECT 1 FROM conversation_members 
-            WHERE conversation_id = ? AND user_id = ?
-        ''', (conversation_id, sender_id)).fetchone()
-        
-        if not member_check:
-            conn.close()
+        message = post_message(conversation_id, sender_id, data['content'])
+        if message is None:
             return {'success': False, 'error': 'Unauthorized'}
         
-        cursor = conn.execute(
-            '''INSERT INTO messages (conversation_id, sender_id, content) 
-               VALUES (?, ?, ?)''',
-            (conversation_id, sender_id, data['content'])
-        )
-        new_id = cursor.lastrowid
-        
-        cursor = conn.execute('''
-            SELECT m.*, u.name as sender_name
-            FROM messages m 
-            JOIN users u ON m.sender_id = u.id
-            WHERE m.id = ?
-        ''', (new_id,))
-        message = dict(cursor.fetchone())
-        conn.commit()
-        conn.close()
-        
-        emit('new_message', message, room=conversation_id)
-        
-        return {'success': True, 'message_id': new_id}
+        return {'success': True, 'message_id': message['id'], 'message': message}
         
     except Exception as e:
         print(f"SocketIO error: {e}")
         return {'success': False, 'error': 'Server error'}
 
-@socketio.on('join_conversation')
+@socket_event('join_conversation')
 def join_conversation(data):
     conversation_id = data.get('conversation_id')
-    user_id = data.get('user_id')
+    user_id = parse_user_id(data.get('user_id'))
     
     try:
         conn = get_db()
-        member = conn.execute('''
-            SELECT 1 FROM conversation_members 
-            WHERE conversation_id = ? AND user_id = ?
-        ''', (conversation_id, user_id)).fetchone()
-        conn.close()
-        
-        if member:
+        if memberships.is_member(conn, conversation_id, user_id):
             join_room(conversation_id)
             emit('joined', {'conversation_id': conversation_id})
         else:
@@ -370,7 +1074,7 @@ def join_conversation(data):
         print(f"Join error: {e}")
         emit('error', {'message': 'Failed to join conversation'})
 
-@socketio.on('leave_conversation')
+@socket_event('leave_conversation')
 def leave_conversation(data):
     try:
         leave_room(data.get('conversation_id'))
@@ -379,6 +1083,15 @@ def leave_conversation(data):
 
 if __name__ == '__main__':
     init_db()
-    print("Starting Chat App on http://localhost:5000")
+    print(f"Starting Chat App on http://{HOST}:{PORT} ({ASYNC_MODE} mode)")
     print("Open UI to chat!")
-    socketio.run(app, debug=True, port=5000)
\ No newline at end of file
+    # Without debug, threading mode still runs the Werkzeug server; it is kept
+    # as a baseline, but eventlet or gevent should serve production traffic
+    options = {'allow_unsafe_werkzeug': True} if ASYNC_MODE == 'threading' else {}
+    # Exit normally on SIGTERM too, so buffered reads are written below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        socketio.run(app, host=HOST, port=PORT, debug=DEBUG, use_reloader=DEBUG, **options)
+    finally:
+        if read_buffer is not None:
+            read_buffer.flush()
\ No newline at end of file
@@ -0,0 +1,1173 @@
+"""Benchmarks for the chat backend.
+
+Each benchmark builds its own throwaway database from chat.db.sql, so none of
+them touch chat.db. Run ``python bench.py <benchmark> --help`` for options.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import seed
+from db import STORAGE_PROFILES, ConnectionPool
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+UNREAD_QUERY = '''
+    SELECT m.conversation_id, COUNT(*) as unread_count
+    FROM messages m
+    JOIN conversation_members cm
+      ON cm.conversation_id = m.conversation_id AND cm.user_id = ?
+    LEFT JOIN message_reads mr ON m.id = mr.message_id AND mr.user_id = ?
+    WHERE mr.message_id IS NULL AND m.sender_id != ?
+    GROUP BY m.conversation_id
+'''
+
+
+def build_db(path, messages, random_seed=0):
+    """Create a migrated database from chat.db.sql with ``messages`` random messages"""
+    conn = seed.create(path)
+    members = conn.execute(
+        'SELECT conversation_id, user_id FROM conversation_members'
+    ).fetchall()
+    rng = random.Random(random_seed)
+    conn.executemany(
+        'INSERT INTO messages (conversation_id, sender_id, content) VALUES (?, ?, ?)',
+        ((*rng.choice(members), f'message {i}') for i in range(messages))
+    )
+    conn.commit()
+    conn.close()
+
+
+def add_direct_conversations(path, user_id, count, start=0):
+    """Give ``user_id`` ``count`` extra direct conversations with new users"""
+    conn = sqlite3.connect(path)
+    for i in range(start, start + count):
+        other = conn.execute(
+            'INSERT INTO users (name) VALUES (?)', (f'bench-user-{i}',)
+        ).lastrowid
+        conv_id = f'bench-dm-{i}'
+        conn.execute(
+            "INSERT INTO conversations (id, name, type) VALUES (?, ?, 'direct')",
+            (conv_id, f'DM {i}')
+        )
+        conn.executemany(
+            'INSERT INTO conversation_members (conversation_id, user_id) VALUES (?, ?)',
+            ((conv_id, user_id), (conv_id, other))
+        )
+    conn.commit()
+    conn.close()
+
+
+def load_app(path):
+    """Import app.py against the database at ``path``"""
+    os.environ['CHAT_DB'] = path
+    import app
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(path, **env):
+    """Run app.py against ``path`` in a subprocess; returns (process, base URL)"""
+    port = free_port()
+    env = dict(os.environ, CHAT_DB=path, CHAT_PORT=str(port), CHAT_DEBUG='0',
+               CHAT_MIGRATE_ON_START='0', **env)
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'app.py')], cwd=ROOT,
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + '/', timeout=1).read()
+            return process, url
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def start_broker():
+    """Run the local:// message queue broker; returns (process, queue URL)"""
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'mq.py'), 'broker',
+                                '--port', str(port)], cwd=ROOT,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, f'local://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'broker on port {port} did not start')
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def http_get(url, timeout=30):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def report(label, samples, elapsed):
+    print(f'  {label:<9} {len(samples):>8} ops  {len(samples) / elapsed:>10.1f} ops/s'
+          f'  p50 {percentile(samples, 50) * 1000:>7.2f} ms'
+          f'  p99 {percentile(samples, 99) * 1000:>7.2f} ms')
+
+
+def bench_profiles(args):
+    """Concurrent unread-count readers against message writers, per storage profile"""
+    for profile in args.profiles:
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'chat.db')
+        build_db(path, args.messages)
+        pool = ConnectionPool(path, size=args.readers + args.writers, profile=profile)
+
+        stop = threading.Event()
+        lock = threading.Lock()
+        reads, writes = [], []
+        errors = [0]
+
+        def reader(user_id):
+            local = []
+            while not stop.is_set():
+                conn = pool.acquire()
+                try:
+                    start = time.perf_counter()
+                    conn.execute(UNREAD_QUERY, (user_id, user_id, user_id)).fetchall()
+                    local.append(time.perf_counter() - start)
+                except sqlite3.OperationalError:
+                    errors[0] += 1
+                finally:
+                    pool.release(conn)
+            with lock:
+                reads.extend(local)
+
+        def writer(sender_id):
+            local = []
+            while not stop.is_set():
+                conn = pool.acquire()
+                try:
+                    start = time.perf_counter()
+                    conn.execute(
+                        'INSERT INTO messages (conversation_id, sender_id, content) '
+                        'VALUES (?, ?, ?)', ('group1', sender_id, 'bench')
+                    )
+                    conn.commit()
+                    local.append(time.perf_counter() - start)
+                except sqlite3.OperationalError:
+                    errors[0] += 1
+                finally:
+                    pool.release(conn)
+            with lock:
+                writes.extend(local)
+
+        threads = [threading.Thread(target=reader, args=(1 + i % 6,))
+                   for i in range(args.readers)]
+        threads += [threading.Thread(target=writer, args=(1 + i % 6,))
+                    for i in range(args.writers)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        print(f'{profile}: {args.readers} readers, {args.writers} writers, '
+              f'{args.messages} seeded messages, {errors[0]} busy errors')
+        report('reads', reads, elapsed)
+        report('writes', writes, elapsed)
+
+        pool.close_all()
+        shutil.rmtree(tmp)
+
+
+def bench_statements(args):
+    """Fail if GET /conversations runs more SQL statements as a user's DMs grow,
+    with and without a buffered read in every conversation"""
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'chat.db')
+    build_db(path, messages=0)
+    # Long enough that the buffered reads are still pending while counted
+    os.environ['CHAT_READ_FLUSH_MS'] = '60000'
+    app = load_app(path)
+
+    statements = []
+    app.pool.on_connect.append(lambda conn: conn.set_trace_callback(statements.append))
+    client = app.app.test_client()
+
+    counts = {}
+    added = 0
+    for size in sorted(set(args.sizes)):
+        add_direct_conversations(path, 1, size - added, start=added)
+        added = size
+        client.get('/conversations?user_id=1')  # warm up pooled connections
+        del statements[:]
+        response = client.get('/conversations?user_id=1')
+        counts[size, 'plain'] = len(statements)
+
+        for conv in response.get_json():
+            app.read_buffer.put((1, conv['id']), 0)
+        del statements[:]
+        client.get('/conversations?user_id=1')
+        counts[size, 'buffered'] = len(statements)
+        app.read_buffer.flush()
+        print(f'{len(response.get_json()):>6} conversations: '
+              f'{counts[size, "plain"]} statements, '
+              f'{counts[size, "buffered"]} with buffered reads')
+
+    app.pool.close_all()
+    shutil.rmtree(tmp)
+
+    # The buffered case adds the statement that recounts past the pending reads
+    for label, allowed in (('plain', args.max_statements),
+                           ('buffered', args.max_statements + 1)):
+        found = {counts[size, label] for size in args.sizes}
+        if len(found) > 1 or max(found) > allowed:
+            print(f'FAIL: expected a constant number of statements '
+                  f'(at most {allowed}) {"with" if label == "buffered" else "without"} '
+                  f'buffered reads')
+            sys.exit(1)
+    print('OK')
+
+
+def bench_seen_by(args):
+    """Fail if listing a message page (with read_count) or GET /messages/<id>/reads
+    runs more SQL statements as the group grows; reports their latency"""
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'chat.db')
+    build_db(path, messages=0)
+    app = load_app(path)
+    statements = []
+    app.pool.on_connect.append(lambda conn: conn.set_trace_callback(statements.append))
+    client = app.app.test_client()
+
+    rng = random.Random(0)
+    conn = sqlite3.connect(path)
+    first_user = conn.execute('SELECT MAX(id) + 1 FROM users').fetchone()[0]
+    conn.executemany('INSERT INTO users (id, name) VALUES (?, ?)',
+                     ((first_user + i, f'bench-member-{i}') for i in range(max(args.sizes))))
+    conn.commit()
+    counts = {}
+    for size in sorted(set(args.sizes)):
+        # A group of ``size`` members where each has read a random prefix
+        conv_id = f'bench-group-{size}'
+        members = [1] + list(range(first_user, first_user + size - 1))
+        with conn:
+            conn.execute("INSERT INTO conversations (id, name, type) VALUES (?, ?, 'group')",
+                         (conv_id, conv_id))
+            conn.executemany('INSERT INTO conversation_members (conversation_id, user_id) '
+                             'VALUES (?, ?)', ((conv_id, user_id) for user_id in members))
+            conn.executemany('INSERT INTO messages (conversation_id, sender_id, content) '
+                             'VALUES (?, ?, ?)', ((conv_id, rng.choice(members), f'message {i}')
+                                                  for i in range(args.messages)))
+            ids = [row[0] for row in conn.execute(
+                'SELECT id FROM messages WHERE conversation_id = ? ORDER BY id', (conv_id,))]
+            for user_id in members[1:]:
+                watermark = rng.choice(ids)
+                conn.execute('UPDATE conversation_members SET last_read_message_id = ? '
+                             'WHERE conversation_id = ? AND user_id = ?',
+                             (watermark, conv_id, user_id))
+                conn.execute('INSERT INTO message_reads (message_id, user_id) '
+                             'SELECT id, ? FROM messages WHERE conversation_id = ? '
+                             'AND id <= ? AND sender_id != ?',
+                             (user_id, conv_id, watermark, user_id))
+
+        page_url = f'/conversations/{conv_id}/messages?user_id=1&limit={args.page_size}'
+        reads_url = f'/messages/{ids[len(ids) // 2]}/reads?user_id=1'
+        for read_model in ('receipts', 'watermark'):
+            app.READ_MODEL = read_model
+            for label, url in (('page', page_url), ('reads', reads_url)):
+                client.get(url)  # warm up pooled connections and caches
+                if app.read_buffer is not None:
+                    app.read_buffer.flush()  # not part of the request being counted
+                del statements[:]
+                samples = []
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    response = client.get(url)
+                    samples.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.status_code
+                counts[size, read_model, label] = len(statements) // args.repeat
+                print(f'{size:>6} members  {read_model:<9}  {label:<5}  '
+                      f'{counts[size, read_model, label]} statements  '
+                      f'p50 {percentile(samples, 50) * 1000:7.2f} ms')
+    conn.close()
+    app.pool.close_all()
+    shutil.rmtree(tmp)
+
+    failures = [(read_model, label) for read_model in ('receipts', 'watermark')
+                for label in ('page', 'reads')
+                if len({counts[size, read_model, label] for size in args.sizes}) > 1]
+    if failures:
+        print(f'FAIL: statements grow with the group size for {failures}')
+        sys.exit(1)
+    print('OK')
+
+
+def full_scans(conn, sql):
+    """Return the EXPLAIN QUERY PLAN steps of ``sql`` that scan a whole table"""
+    plan = conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+    # "SCAN t USING [COVERING] INDEX i" still visits every entry of the index;
+    # only SEARCH steps are bounded by the WHERE clause. FTS5 lookups show as
+    # "SCAN t VIRTUAL TABLE INDEX n:M..." when a MATCH constraint drives them.
+    return [detail for _, _, _, detail in plan
+            if detail.startswith('SCAN ')
+            and not detail.startswith(('SCAN CONSTANT ROW', 'SCAN (subquery'))
+            and not ('VIRTUAL TABLE INDEX' in detail and ':M' in detail)]
+
+
+def bench_plans(args):
+    """Fail if any SQL statement issued by app.py plans a full table scan"""
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'chat.db')
+    build_db(path, args.messages)
+    add_direct_conversations(path, 1, args.dms)
+    app = load_app(path)
+
+    statements = []
+    app.pool.on_connect.append(lambda conn: conn.set_trace_callback(statements.append))
+    client = app.app.test_client()
+
+    # Drive every route and socket handler once per read model
+    for read_model in ('receipts', 'watermark'):
+        app.READ_MODEL = read_model
+        client.get('/')
+        client.get('/metrics')
+        client.get('/debug/profile')
+        client.get('/conversations?user_id=1')
+        page = client.get('/conversations/group1/messages?user_id=1&limit=20').get_json()
+        client.get(f'/conversations/group1/messages?user_id=1&limit=20'
+                   f'&before_id={page["next_before_id"]}')
+        client.get(f'/conversations/group1/messages?user_id=1'
+                   f'&after_id={page["messages"][0]["id"]}')
+        client.post('/messages', json={'conversation_id': 'group1', 'sender_id': 2,
+                                       'content': 'plan check'})
+        client.post('/conversations/group1/read', json={'user_id': 1})
+        client.get(f'/messages/{page["messages"][0]["id"]}/reads?user_id=1')
+        client.get('/users/1')
+        client.get('/users?ids=1,2,3')
+        client.get('/conversations/group1/members')
+        client.get('/search?user_id=1&q=message+1')
+        client.get('/search?user_id=1&q=plan&conversation_id=group1')
+
+        socket = app.socketio.test_client(app.app)
+        socket.emit('authenticate', {'user_id': 1})
+        socket.emit('join_conversation', {'conversation_id': 'group1', 'user_id': 1})
+        socket.emit('message', {'conversation_id': 'group1', 'sender_id': 1,
+                                'content': 'plan check'}, callback=True)
+        socket.disconnect()
+        # Buffered reads are written by the flush, under the current read model
+        if app.read_buffer is not None:
+            app.read_buffer.flush()
+
+    conn = sqlite3.connect(path)
+    failures = 0
+    seen = set()
+    for sql in statements:
+        sql = ' '.join(sql.split())
+        if sql in seen or not sql.upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE')):
+            continue
+        # FTS5 reads and writes its own shadow tables through the same trace hook
+        if "'messages_fts_" in sql:
+            continue
+        seen.add(sql)
+        scans = full_scans(conn, sql)
+        if scans:
+            failures += 1
+            print(f'FULL SCAN ({", ".join(scans)}): {sql}')
+    conn.close()
+    app.pool.close_all()
+    shutil.rmtree(tmp)
+
+    print(f'{len(seen)} distinct statements checked, {failures} with full table scans')
+    if failures:
+        sys.exit(1)
+
+
+def bench_enrich(args):
+    """Cost of fetching a message page with a users JOIN vs the user directory"""
+    from cache import UserDirectory
+
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'chat.db')
+    build_db(path, args.messages)
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    page_sql = '''
+        SELECT m.*{columns} FROM messages m {join}
+        WHERE m.conversation_id = ? ORDER BY m.id DESC LIMIT ?
+    '''
+    joined = page_sql.format(columns=', u.name as sender_name',
+                             join='JOIN users u ON m.sender_id = u.id')
+    plain = page_sql.format(columns='', join='')
+    directory = UserDirectory()
+    conversations = [row[0] for row in conn.execute('SELECT id FROM conversations')]
+    rng = random.Random(0)
+
+    def with_join(conversation_id, limit):
+        return [dict(row) for row in conn.execute(joined, (conversation_id, limit))]
+
+    def with_directory(conversation_id, limit):
+        rows = [dict(row) for row in conn.execute(plain, (conversation_id, limit))]
+        return directory.attach_sender_names(conn, rows)
+
+    for limit in args.page_sizes:
+        print(f'page of {limit} messages:')
+        for label, fetch in (('join', with_join), ('cache', with_directory)):
+            samples = []
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                began = time.perf_counter()
+                fetch(rng.choice(conversations), limit)
+                samples.append(time.perf_counter() - began)
+            elapsed = time.perf_counter() - start
+            report(label, samples, elapsed)
+            per_message = sum(samples) / len(samples) / limit * 1e6
+            print(f'  {"":<8} {per_message:.2f} us per message')
+    print(f'user directory: {directory.stats()}')
+    conn.close()
+    shutil.rmtree(tmp)
+
+
+def bench_wire(args):
+    """Bytes on the wire and encode time of message pages per format/compression"""
+    import wire
+
+    rng = random.Random(0)
+    words = ['hey', 'ok', 'meeting', 'tomorrow', 'lunch', 'project', 'deadline', 'sounds',
+             'good', 'thanks', 'see', 'you', 'there', 'running', 'late', 'call', 'me',
+             'when', 'free', 'the', 'build', 'is', 'green', 'again', 'review', 'please']
+
+    def message(i):
+        sender = rng.randint(1, 6)
+        return {'id': 100000 + i, 'conversation_id': 'group1', 'sender_id': sender,
+                'content': ' '.join(rng.choice(words) for _ in range(rng.randint(2, 25))),
+                'created_at': f'2026-01-15 10:{i // 60 % 60:02d}:{i % 60:02d}',
+                'is_read': rng.randint(0, 1), 'sender_name': f'user{sender}'}
+
+    formats = {'json': lambda obj: json.dumps(obj, separators=(',', ':')).encode()}
+    if wire.msgpack is not None:
+        formats['msgpack'] = wire.pack
+    else:
+        print('msgpack not installed; skipping MessagePack rows')
+    if wire.brotli is None:
+        print('brotli not installed; skipping br rows')
+
+    def timed(fn, value):
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            result = fn(value)
+        return result, (time.perf_counter() - start) / args.iterations
+
+    for size in args.page_sizes:
+        page = {'messages': [message(i) for i in range(size)], 'has_more': True,
+                'next_before_id': 100000, 'next_after_id': 100000 + size - 1}
+        payload = page if size > 1 else page['messages'][0]  # one message ~ a new_message event
+        print(f'{size} message(s):')
+        for name, encode in formats.items():
+            body, encode_time = timed(encode, payload)
+            print(f'  {name:<14} {len(body):>8} bytes  {encode_time * 1e6:>9.1f} us')
+            for encoding, compress in wire.ENCODERS.items():
+                packed, compress_time = timed(compress, body)
+                print(f'  {name + "+" + encoding:<14} {len(packed):>8} bytes  '
+                      f'{(encode_time + compress_time) * 1e6:>9.1f} us')
+
+
+def bench_server(args):
+    """Socket.IO connection capacity and REST latency of app.py per async mode"""
+    import socketio
+
+    for mode in args.modes:
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'chat.db')
+        build_db(path, args.messages)
+        add_direct_conversations(path, 1, args.dms)
+        process, url = start_server(path, CHAT_ASYNC_MODE=mode)
+
+        # Phase 1: open socket clients concurrently, each authenticating as one
+        # of the seeded users (all of whom are in group1)
+        clients, failures = [], [0]
+        received = {}
+        lock = threading.Lock()
+
+        def connect(i):
+            client = socketio.Client(reconnection=False)
+            got = threading.Event()
+            client.on('new_message', lambda message: got.set())
+            try:
+                client.connect(url, transports=['websocket'], wait_timeout=args.timeout)
+                client.call('authenticate', {'user_id': 1 + i % 6}, timeout=args.timeout)
+            except Exception:
+                with lock:
+                    failures[0] += 1
+                return
+            with lock:
+                clients.append(client)
+                received[client] = got
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=connect, args=(i,)) for i in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        connect_time = time.perf_counter() - start
+
+        # Phase 2: REST readers while every socket stays connected; the
+        # conversation list for user 1 is the heavy request
+        latencies, errors = [], [0]
+        stop = threading.Event()
+
+        def reader(i):
+            local = []
+            paths = ['/conversations?user_id=1',
+                     '/conversations/group1/messages?user_id=2',
+                     '/users/3']
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    http_get(url + paths[i % len(paths)])
+                    local.append(time.perf_counter() - started)
+                except OSError:
+                    errors[0] += 1
+            with lock:
+                latencies.extend(local)
+
+        readers = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+        started = time.perf_counter()
+        for t in readers:
+            t.start()
+
+        # Phase 3: fan one message out to every connected client mid-load
+        time.sleep(args.duration / 2)
+        fanout_start = time.perf_counter()
+        delivered = 0
+        if clients:
+            clients[0].call('message', {'conversation_id': 'group1', 'sender_id': 1,
+                                        'content': 'fan-out'}, timeout=args.timeout)
+            deadline = time.time() + args.timeout
+            for got in received.values():
+                if got.wait(max(0, deadline - time.time())):
+                    delivered += 1
+        fanout_time = time.perf_counter() - fanout_start
+
+        time.sleep(max(0, args.duration - (time.perf_counter() - started)))
+        stop.set()
+        for t in readers:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        print(f'{mode}: {len(clients)}/{args.clients} sockets connected in {connect_time:.2f}s '
+              f'({failures[0]} failed); fan-out reached {delivered} in {fanout_time * 1000:.0f} ms; '
+              f'{errors[0]} REST errors')
+        report('rest', latencies, elapsed)
+        cache = http_get(url + '/')['membership_cache']
+        print(f'  membership cache: {cache["hits"]} hits, {cache["misses"]} misses '
+              f'(hit rate {cache["hit_rate"]:.1%})')
+
+        closers = [threading.Thread(target=client.disconnect, daemon=True) for client in clients]
+        for t in closers:
+            t.start()
+        for t in closers:
+            t.join(args.timeout)
+        stop_server(process)
+        shutil.rmtree(tmp)
+
+
+def bench_ingest(args):
+    """Socket.IO message throughput and ack latency per group-commit batch size"""
+    import socketio
+
+    for batch in args.batches:
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'chat.db')
+        build_db(path, 0)
+        process, url = start_server(path, CHAT_ASYNC_MODE=args.mode,
+                                    CHAT_DB_PROFILE=args.profile,
+                                    CHAT_INGEST_BATCH=str(batch),
+                                    CHAT_INGEST_DELAY_MS=str(args.delay_ms))
+
+        # Senders stay out of the conversation rooms so the numbers measure
+        # ingestion rather than fan-out
+        latencies, errors = [], [0]
+        lock = threading.Lock()
+        stop = threading.Event()
+        ready = threading.Barrier(args.senders + 1)
+
+        def sender(i):
+            client = socketio.Client(reconnection=False)
+            client.connect(url, transports=['websocket'], wait_timeout=args.timeout)
+            local = []
+            ready.wait()
+            while not stop.is_set():
+                started = time.perf_counter()
+                ack = client.call('message', {'conversation_id': 'group1',
+                                              'sender_id': 1 + i % 6,
+                                              'content': f'load {i}'}, timeout=args.timeout)
+                if ack.get('success'):
+                    local.append(time.perf_counter() - started)
+                else:
+                    errors[0] += 1
+            client.disconnect()
+            with lock:
+                latencies.extend(local)
+
+        threads = [threading.Thread(target=sender, args=(i,)) for i in range(args.senders)]
+        for t in threads:
+            t.start()
+        ready.wait()
+        started = time.perf_counter()
+        time.sleep(args.duration)
+        stop.set()
+        # Before the joins: senders disconnect their clients on the way out
+        elapsed = time.perf_counter() - started
+        for t in threads:
+            t.join()
+
+        stats = http_get(url + '/')['ingest']
+        label = f'batch {batch}' if batch else 'no batching'
+        mean = f', mean batch {stats["mean_batch"]}' if stats else ''
+        print(f'{label} ({args.senders} senders, {args.profile}{mean}, {errors[0]} errors)')
+        report('acks', latencies, elapsed)
+
+        stop_server(process)
+        shutil.rmtree(tmp)
+
+
+def bench_fanout(args):
+    """Room fan-out across app.py worker processes sharing a message queue"""
+    import socketio
+
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'chat.db')
+    build_db(path, 0)
+    broker, queue_url = start_broker()
+    failed = False
+
+    for workers in args.workers:
+        servers = [start_server(path, CHAT_ASYNC_MODE=args.mode, CHAT_MESSAGE_QUEUE=queue_url)
+                   for _ in range(workers)]
+        urls = [url for _, url in servers]
+
+        # Spread listeners over the workers; every one of them is in group1
+        counts = [0] * args.clients
+        lock = threading.Lock()
+        listeners = []
+        for i in range(args.clients):
+            client = socketio.Client(reconnection=False)
+
+            def on_message(message, i=i):
+                with lock:
+                    counts[i] += 1
+            client.on('new_message', on_message)
+            client.connect(urls[i % workers], transports=['websocket'],
+                           wait_timeout=args.timeout)
+            client.call('authenticate', {'user_id': 1 + i % 6}, timeout=args.timeout)
+            listeners.append(client)
+
+        # Correctness: a message sent on worker A reaches clients on every worker
+        listeners[0].call('message', {'conversation_id': 'group1', 'sender_id': 1,
+                                      'content': 'cross-worker'}, timeout=args.timeout)
+        deadline = time.time() + args.timeout
+        while time.time() < deadline and not all(counts):
+            time.sleep(0.05)
+        missed = sum(1 for c in counts if not c)
+        if missed:
+            failed = True
+
+        # Throughput: one sender per worker, each on its own connection
+        for i in range(len(counts)):
+            counts[i] = 0
+        sent = [0] * workers
+        stop = threading.Event()
+
+        def sender(w):
+            client = socketio.Client(reconnection=False)
+            client.connect(urls[w], transports=['websocket'], wait_timeout=args.timeout)
+            client.call('authenticate', {'user_id': 1 + w % 6}, timeout=args.timeout)
+            while not stop.is_set():
+                client.call('message', {'conversation_id': 'group1', 'sender_id': 1 + w % 6,
+                                        'content': 'load'}, timeout=args.timeout)
+                sent[w] += 1
+            client.disconnect()
+
+        senders = [threading.Thread(target=sender, args=(w,)) for w in range(workers)]
+        started = time.perf_counter()
+        for t in senders:
+            t.start()
+        time.sleep(args.duration)
+        stop.set()
+        # Before the joins: senders disconnect their clients on the way out
+        elapsed = time.perf_counter() - started
+        for t in senders:
+            t.join()
+        time.sleep(1)  # let in-flight broadcasts land
+
+        expected = sum(sent) * len(listeners)
+        delivered = sum(counts)
+        print(f'{workers} worker(s): cross-worker delivery missed {missed}/{len(listeners)}; '
+              f'{sum(sent) / elapsed:.0f} msgs/sec sent, {delivered / elapsed:.0f} deliveries/sec '
+              f'({delivered}/{expected} delivered)')
+
+        closers = [threading.Thread(target=client.disconnect, daemon=True) for client in listeners]
+        for t in closers:
+            t.start()
+        for t in closers:
+            t.join(args.timeout)
+        for process, _ in servers:
+            stop_server(process)
+
+    stop_server(broker)
+    shutil.rmtree(tmp)
+    if failed:
+        print('FAIL: messages did not reach clients on other workers')
+        sys.exit(1)
+
+
+
+def bench_reads(args):
+    """Concurrent conversation opens (GET /messages marks them read) with read
+    receipts written inline vs buffered"""
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'chat.db')
+    conn = seed.create(path)
+    seed.populate(conn, users=args.users, dms=args.users, groups=args.users // 10,
+                  messages=args.messages, log=lambda message: None)
+    pairs = conn.execute('SELECT user_id, conversation_id FROM conversation_members').fetchall()
+    conn.close()
+
+    for run, flush_ms in enumerate(args.flush_ms):
+        # A fresh copy per run: the previous server leaves its WAL behind
+        path = os.path.join(tmp, f'run{run}.db')
+        shutil.copy(os.path.join(tmp, 'chat.db'), path)
+        process, url = start_server(path, CHAT_ASYNC_MODE=args.mode, CHAT_READ_MODEL=args.read_model,
+                                    CHAT_READ_FLUSH_MS=str(flush_ms))
+        opens, sends, errors = [], [], [0]
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def reader(i):
+            rng = random.Random(i)
+            local = []
+            while not stop.is_set():
+                user_id, conv_id = rng.choice(pairs)
+                started = time.perf_counter()
+                try:
+                    http_get(f'{url}/conversations/{conv_id}/messages?user_id={user_id}')
+                    local.append(time.perf_counter() - started)
+                except OSError:
+                    errors[0] += 1
+            with lock:
+                opens.extend(local)
+
+        def sender(i):
+            # Keeps new messages arriving so that opens have something to mark
+            rng = random.Random(-1 - i)
+            local = []
+            while not stop.is_set():
+                user_id, conv_id = rng.choice(pairs)
+                body = json.dumps({'conversation_id': conv_id, 'sender_id': user_id,
+                                   'content': 'bench'}).encode()
+                request = urllib.request.Request(f'{url}/messages', data=body,
+                                                 headers={'Content-Type': 'application/json'})
+                started = time.perf_counter()
+                try:
+                    urllib.request.urlopen(request, timeout=30).read()
+                    local.append(time.perf_counter() - started)
+                except OSError:
+                    errors[0] += 1
+            with lock:
+                sends.extend(local)
+
+        threads = ([threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+                   + [threading.Thread(target=sender, args=(i,)) for i in range(args.senders)])
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        time.sleep(args.duration)
+        stop.set()
+        elapsed = time.perf_counter() - started
+        for t in threads:
+            t.join()
+
+        buffered = http_get(url + '/')['read_buffer']
+        label = f'buffered, flushed every {flush_ms:g} ms' if flush_ms else 'written inline'
+        extra = (f', {buffered["items"]} reads in {buffered["flushes"]} flushes'
+                 if buffered else '')
+        print(f'{label} ({args.readers} readers, {args.senders} senders, {args.read_model}'
+              f'{extra}, {errors[0]} errors)')
+        report('opens', opens, elapsed)
+        report('sends', sends, elapsed)
+        stop_server(process)
+
+    shutil.rmtree(tmp)
+
+
+def bench_search(args):
+    """FTS5 indexing throughput and /search latency on a large message corpus"""
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'chat.db')
+    build_db(path, 0)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    members = conn.execute(
+        'SELECT conversation_id, user_id FROM conversation_members'
+    ).fetchall()
+    rng = random.Random(0)
+
+    # Inserting goes through the messages_fts triggers, as the app's writes do
+    started = time.perf_counter()
+    for start in range(0, args.messages, 50000):
+        conn.executemany(
+            'INSERT INTO messages (conversation_id, sender_id, content) VALUES (?, ?, ?)',
+            ((*rng.choice(members), seed.random_text(rng))
+             for _ in range(min(50000, args.messages - start)))
+        )
+        conn.commit()
+    elapsed = time.perf_counter() - started
+    print(f'{args.messages} messages inserted and indexed in {elapsed:.1f}s '
+          f'({args.messages / elapsed:,.0f} rows/s)')
+
+    # Rebuilding from scratch is what the migration's backfill amounts to
+    started = time.perf_counter()
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    conn.commit()
+    elapsed = time.perf_counter() - started
+    print(f'index rebuilt in {elapsed:.1f}s ({args.messages / elapsed:,.0f} rows/s), '
+          f'database {os.path.getsize(path) / 1e6:.0f} MB')
+    conn.close()
+
+    app = load_app(path)
+    client = app.app.test_client()
+    queries = {
+        'rare': 'zq4242',
+        'common': 'lunch',
+        'two-word': 'deploy friday',
+        'prefix': 'datab',
+    }
+    print(f'/search, {args.iterations} requests per query (limit {args.limit})')
+    for label, q in queries.items():
+        samples = []
+        started = time.perf_counter()
+        for i in range(args.iterations):
+            url = f'/search?user_id={1 + i % 6}&q={q.replace(" ", "+")}&limit={args.limit}'
+            t0 = time.perf_counter()
+            response = client.get(url)
+            samples.append(time.perf_counter() - t0)
+            if response.status_code != 200:
+                raise RuntimeError(f'{url} returned {response.status_code}')
+        report(label, samples, time.perf_counter() - started)
+
+    app.pool.close_all()
+    shutil.rmtree(tmp)
+
+
+# Relative frequency of each action a simulated user takes between pauses
+LOAD_MIX = {
+    'convs': 25,      # GET /conversations (revalidated with If-None-Match)
+    'messages': 25,   # open a conversation: GET its newest page (marks it read)
+    'history': 5,     # scroll back: GET an older page
+    'send-ws': 15,    # send over Socket.IO and wait for the ack
+    'send-rest': 5,   # POST /messages
+    'read': 10,       # POST /conversations/<id>/read
+    'members': 8,     # GET /conversations/<id>/members
+    'users': 4,       # GET /users?ids=...
+    'search': 3,      # GET /search
+}
+
+
+def http_call(url, method='GET', body=None, headers=None, timeout=30):
+    """Return (status, headers, parsed JSON body or None); 304 is not an error"""
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, method=method, headers=dict(
+        headers or {}, **({'Content-Type': 'application/json'} if data else {})))
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.headers, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return 304, e.headers, None
+        raise
+
+
+def bench_load(args):
+    """Mixed REST and Socket.IO traffic from simulated users, with latency per endpoint"""
+    import socketio
+
+    tmp = None
+    if args.url:
+        url, process = args.url.rstrip('/'), None
+        user_ids = list(range(1, args.max_user_id + 1))
+    else:
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'chat.db')
+        conn = seed.create(path)
+        seed.populate(conn, users=args.users, dms=args.dms, groups=args.groups,
+                      messages=args.messages, log=lambda message: None)
+        user_ids = [row[0] for row in conn.execute(
+            'SELECT DISTINCT user_id FROM conversation_members')]
+        conn.close()
+        process, url = start_server(path, CHAT_ASYNC_MODE=args.mode,
+                                    CHAT_DB_PROFILE=args.profile)
+
+    actions, weights = zip(*LOAD_MIX.items())
+    latencies = {name: [] for name in actions + ('deliver',)}
+    errors = {name: 0 for name in actions}
+    lock = threading.Lock()
+    stop = threading.Event()
+    ready = threading.Barrier(args.clients + 1)
+    rng = random.Random(0)
+    users = rng.sample(user_ids, min(args.clients, len(user_ids)))
+
+    def simulate(i):
+        user_id = users[i % len(users)]
+        local = {name: [] for name in latencies}
+        failed = dict.fromkeys(actions, 0)
+        rng = random.Random(i)
+        etags = {}
+
+        def on_message(message):
+            # Load messages carry their send time, so delivery latency can be
+            # measured for every member who receives them
+            try:
+                sent = float(message['content'].rsplit(' ', 1)[1])
+            except (KeyError, IndexError, ValueError):
+                return
+            local['deliver'].append(time.time() - sent)
+
+        client = socketio.Client(reconnection=False)
+        client.on('new_message', on_message)
+        try:
+            client.connect(url, transports=['websocket'], wait_timeout=args.timeout)
+            client.call('authenticate', {'user_id': user_id}, timeout=args.timeout)
+            conversations = [c['id'] for c in http_call(
+                f'{url}/conversations?user_id={user_id}')[2]]
+        finally:
+            ready.wait()
+
+        oldest = {}
+        while not stop.is_set() and conversations:
+            action = rng.choices(actions, weights)[0]
+            conv_id = rng.choice(conversations)
+            base = f'{url}/conversations/{conv_id}'
+            started = time.perf_counter()
+            try:
+                if action == 'convs':
+                    target = f'{url}/conversations?user_id={user_id}'
+                    status, headers, _ = http_call(
+                        target, headers={'If-None-Match': etags.get(target, '')})
+                    etags[target] = headers.get('ETag', '')
+                elif action == 'messages':
+                    page = http_call(f'{base}/messages?user_id={user_id}')[2]
+                    oldest[conv_id] = page['next_before_id']
+                elif action == 'history':
+                    before = oldest.get(conv_id)
+                    query = f'&before_id={before}' if before else ''
+                    page = http_call(f'{base}/messages?user_id={user_id}{query}')[2]
+                    oldest[conv_id] = page['next_before_id']
+                elif action == 'send-ws':
+                    ack = client.call('message', {'conversation_id': conv_id,
+                                                  'sender_id': user_id,
+                                                  'content': f'load {time.time():.6f}'},
+                                      timeout=args.timeout)
+                    if not ack.get('success'):
+                        raise RuntimeError(ack.get('error'))
+                elif action == 'send-rest':
+                    http_call(f'{url}/messages', 'POST', {'conversation_id': conv_id,
+                                                         'sender_id': user_id,
+                                                         'content': f'load {time.time():.6f}'})
+                elif action == 'read':
+                    http_call(f'{base}/read', 'POST', {'user_id': user_id})
+                elif action == 'members':
+                    target = f'{base}/members'
+                    status, headers, _ = http_call(
+                        target, headers={'If-None-Match': etags.get(target, '')})
+                    etags[target] = headers.get('ETag', '')
+                elif action == 'users':
+                    ids = ','.join(str(u) for u in rng.sample(user_ids, min(20, len(user_ids))))
+                    http_call(f'{url}/users?ids={ids}')
+                elif action == 'search':
+                    http_call(f'{url}/search?user_id={user_id}&q={rng.choice(seed.WORDS[10:])}')
+                local[action].append(time.perf_counter() - started)
+            except Exception:
+                failed[action] += 1
+            if args.think_ms:
+                stop.wait(rng.expovariate(1000 / args.think_ms))
+
+        client.disconnect()
+        with lock:
+            for name, samples in local.items():
+                latencies[name].extend(samples)
+            for name, count in failed.items():
+                errors[name] += count
+
+    threads = [threading.Thread(target=simulate, args=(i,)) for i in range(args.clients)]
+    for t in threads:
+        t.start()
+    ready.wait()
+    started = time.perf_counter()
+    time.sleep(args.duration)
+    stop.set()
+    elapsed = time.perf_counter() - started
+    for t in threads:
+        t.join(args.timeout * 2)
+
+    total = sum(len(latencies[name]) for name in actions)
+    print(f'{args.clients} simulated users against {url if args.url else args.mode}: '
+          f'{total / elapsed:.1f} requests/s, {sum(errors.values())} errors')
+    for name in latencies:
+        report(name, latencies[name], elapsed)
+        if errors.get(name):
+            print(f'  {"":<9} {errors[name]:>8} errors')
+
+    if process:
+        stop_server(process)
+        shutil.rmtree(tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = sub.add_parser('profiles', help=bench_profiles.__doc__)
+    p.add_argument('--profiles', nargs='+', default=list(STORAGE_PROFILES),
+                   choices=list(STORAGE_PROFILES))
+    p.add_argument('--messages', type=int, default=20000)
+    p.add_argument('--readers', type=int, default=4)
+    p.add_argument('--writers', type=int, default=1)
+    p.add_argument('--duration', type=float, default=5.0)
+    p.set_defaults(func=bench_profiles)
+
+    p = sub.add_parser('statements', help=bench_statements.__doc__)
+    p.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 500])
+    p.add_argument('--max-statements', type=int, default=2)
+    p.set_defaults(func=bench_statements)
+
+    p = sub.add_parser('seen-by', help=bench_seen_by.__doc__)
+    p.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 500])
+    p.add_argument('--messages', type=int, default=2000)
+    p.add_argument('--page-size', type=int, default=50)
+    p.add_argument('--repeat', type=int, default=50)
+    p.set_defaults(func=bench_seen_by)
+
+    p = sub.add_parser('plans', help=bench_plans.__doc__)
+    p.add_argument('--messages', type=int, default=100000)
+    p.add_argument('--dms', type=int, default=200)
+    p.set_defaults(func=bench_plans)
+
+    p = sub.add_parser('enrich', help=bench_enrich.__doc__)
+    p.add_argument('--messages', type=int, default=100000)
+    p.add_argument('--page-sizes', nargs='+', type=int, default=[50, 200])
+    p.add_argument('--iterations', type=int, default=2000)
+    p.set_defaults(func=bench_enrich)
+
+    p = sub.add_parser('wire', help=bench_wire.__doc__)
+    p.add_argument('--page-sizes', nargs='+', type=int, default=[1, 50, 200])
+    p.add_argument('--iterations', type=int, default=200)
+    p.set_defaults(func=bench_wire)
+
+    p = sub.add_parser('server', help=bench_server.__doc__)
+    p.add_argument('--modes', nargs='+', default=['threading', 'eventlet', 'gevent'],
+                   choices=['threading', 'eventlet', 'gevent'])
+    p.add_argument('--clients', type=int, default=200)
+    p.add_argument('--readers', type=int, default=16)
+    p.add_argument('--messages', type=int, default=20000)
+    p.add_argument('--dms', type=int, default=500)
+    p.add_argument('--duration', type=float, default=10.0)
+    p.add_argument('--timeout', type=float, default=10.0)
+    p.set_defaults(func=bench_server)
+
+    p = sub.add_parser('ingest', help=bench_ingest.__doc__)
+    p.add_argument('--batches', nargs='+', type=int, default=[0, 1, 16, 64, 256],
+                   help='CHAT_INGEST_BATCH values; 0 commits every message on its own')
+    p.add_argument('--delay-ms', type=float, default=0.0)
+    p.add_argument('--profile', default='durable', choices=list(STORAGE_PROFILES))
+    p.add_argument('--mode', default='threading', choices=['threading', 'eventlet', 'gevent'])
+    p.add_argument('--senders', type=int, default=32)
+    p.add_argument('--duration', type=float, default=5.0)
+    p.add_argument('--timeout', type=float, default=10.0)
+    p.set_defaults(func=bench_ingest)
+
+    p = sub.add_parser('fanout', help=bench_fanout.__doc__)
+    p.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4])
+    p.add_argument('--mode', default='threading', choices=['threading', 'eventlet', 'gevent'])
+    p.add_argument('--clients', type=int, default=24)
+    p.add_argument('--duration', type=float, default=5.0)
+    p.add_argument('--timeout', type=float, default=10.0)
+    p.set_defaults(func=bench_fanout)
+
+    p = sub.add_parser('reads', help=bench_reads.__doc__)
+    p.add_argument('--flush-ms', nargs='+', type=float, default=[0, 200],
+                   help='CHAT_READ_FLUSH_MS values; 0 writes receipts inside the request')
+    p.add_argument('--read-model', default='receipts', choices=['receipts', 'watermark'])
+    p.add_argument('--mode', default='threading', choices=['threading', 'eventlet', 'gevent'])
+    p.add_argument('--users', type=int, default=200)
+    p.add_argument('--messages', type=int, default=50000)
+    p.add_argument('--readers', type=int, default=16)
+    p.add_argument('--senders', type=int, default=2)
+    p.add_argument('--duration', type=float, default=10.0)
+    p.set_defaults(func=bench_reads)
+
+    p = sub.add_parser('search', help=bench_search.__doc__)
+    p.add_argument('--messages', type=int, default=1000000)
+    p.add_argument('--iterations', type=int, default=200)
+    p.add_argument('--limit', type=int, default=20)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser('load', help=bench_load.__doc__)
+    p.add_argument('--url', help='drive a running server instead of starting one on a '
+                                 'seeded throwaway database')
+    p.add_argument('--max-user-id', type=int, default=1000,
+                   help='with --url, simulated users are picked from ids 1..N')
+    p.add_argument('--users', type=int, default=2000)
+    p.add_argument('--dms', type=int, default=4000)
+    p.add_argument('--groups', type=int, default=300)
+    p.add_argument('--messages', type=int, default=200000)
+    p.add_argument('--mode', default='threading', choices=['threading', 'eventlet', 'gevent'])
+    p.add_argument('--profile', default='durable', choices=list(STORAGE_PROFILES))
+    p.add_argument('--clients', type=int, default=50, help='simulated users')
+    p.add_argument('--think-ms', type=float, default=200.0,
+                   help='mean pause between a simulated user\'s actions')
+    p.add_argument('--duration', type=float, default=20.0)
+    p.add_argument('--timeout', type=float, default=10.0)
+    p.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
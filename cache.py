@@ -0,0 +1,219 @@
+"""In-process caches for data that is read on every request but rarely changes.
+
+Each worker process keeps its own copy. Code that changes the underlying
+tables should call the matching ``invalidate`` method; changes made outside the
+process (manage.py, another worker, the sqlite3 shell) are picked up after a
+short delay, described on each class.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class MembershipCache:
+    """LRU cache of conversation_id -> frozenset of member user ids, used for
+    the membership check that guards every conversation endpoint"""
+
+    def __init__(self, max_conversations=10000, ttl=60.0):
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by invalidate() so a load that raced an invalidation is not
+        # stored
+        self._generation = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def members(self, conn, conversation_id):
+        """Return the user ids in a conversation, loading them with ``conn``
+        on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._entries.move_to_end(conversation_id)
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+            generation = self._generation
+
+        members = frozenset(row[0] for row in conn.execute('''
+            SELECT user_id FROM conversation_members WHERE conversation_id = ?
+        ''', (conversation_id,)))
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[conversation_id] = (members, now)
+                self._entries.move_to_end(conversation_id)
+                while len(self._entries) > self.max_conversations:
+                    self._entries.popitem(last=False)
+                    self._evictions += 1
+        return members
+
+    def is_member(self, conn, conversation_id, user_id):
+        """Whether ``user_id``, an int as returned by app.parse_user_id, is a
+        member. Anything else is not a member: a bool would otherwise compare
+        equal to user 0 or 1."""
+        if type(user_id) is not int:
+            return False
+        return user_id in self.members(conn, conversation_id)
+
+    def invalidate(self, conversation_id=None):
+        """Forget one conversation's members, or every conversation's"""
+        with self._lock:
+            self._generation += 1
+            self._invalidations += 1
+            if conversation_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(conversation_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_conversations,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 3) if lookups else 0.0,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations,
+            }
+
+
+class UserDirectory:
+    """Cache of user profiles (id, name, avatar) keyed by user id, used to
+    attach sender names to messages without joining users.
+
+    The users_version row (see migrations/0004_users_version.sql) is bumped
+    by a trigger on every change to users. The directory remembers the version
+    its entries were loaded at, re-reads it at most every ``check_interval``
+    seconds, and drops every entry once it has moved on. ``invalidate()``
+    forces that check on the next lookup.
+    """
+
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self._users = {}
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        # Wall-clock time the current version was first seen
+        self.changed_at = time.time()
+
+        self._hits = 0
+        self._misses = 0
+        self._reloads = 0
+
+    def _check_version(self, conn):
+        now = time.monotonic()
+        with self._lock:
+            if self._version is not None and now - self._checked_at < self.check_interval:
+                return
+        version = conn.execute('SELECT version FROM users_version WHERE id = 1').fetchone()[0]
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    self._reloads += 1
+                self._users.clear()
+                self._version = version
+                self.changed_at = time.time()
+            self._checked_at = now
+
+    def version(self, conn):
+        """The users_version the cached profiles belong to"""
+        self._check_version(conn)
+        with self._lock:
+            return self._version
+
+    def get_many(self, conn, user_ids):
+        """Return {user_id: profile} for the ids that exist"""
+        self._check_version(conn)
+        found, missing = {}, set()
+        with self._lock:
+            for user_id in set(user_ids):
+                user = self._users.get(user_id)
+                if user is None:
+                    missing.add(user_id)
+                else:
+                    found[user_id] = user
+            self._hits += len(found)
+            self._misses += len(missing)
+            version = self._version
+
+        loaded = {}
+        missing = sorted(missing)
+        # Stay under SQLite's limit on bound parameters
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            loaded.update((row['id'], dict(row)) for row in conn.execute(
+                f'SELECT id, name, avatar FROM users WHERE id IN ({placeholders})',
+                chunk))
+        if loaded:
+            with self._lock:
+                if version == self._version:
+                    self._users.update(loaded)
+            found.update(loaded)
+        return found
+
+    def get(self, conn, user_id):
+        return self.get_many(conn, (user_id,)).get(user_id)
+
+    def attach_sender_names(self, conn, messages):
+        """Set sender_name on message dicts from their sender_id"""
+        users = self.get_many(conn, {m['sender_id'] for m in messages})
+        for message in messages:
+            user = users.get(message['sender_id'])
+            message['sender_name'] = user['name'] if user else None
+        return messages
+
+    def invalidate(self):
+        with self._lock:
+            self._checked_at = 0.0
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': len(self._users),
+                'version': self._version,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 3) if lookups else 0.0,
+                'reloads': self._reloads,
+            }
+
+
+class VersionCounters:
+    """Change counters behind ETag/Last-Modified validators. Writers bump the
+    keys their change affects (e.g. ``('user', 7)``) after committing; a
+    response built for a key is current as long as its version is unchanged.
+
+    Counters start at 0 in every process, so validators include ``epoch``, a
+    random token per process: a tag issued before a restart never matches.
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.started_at = time.time()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def bump(self, *keys):
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                version, _ = self._versions.get(key, (0, now))
+                self._versions[key] = (version + 1, now)
+
+    def get(self, key):
+        """Return (version, last modified wall-clock time) for ``key``"""
+        with self._lock:
+            return self._versions.get(key, (0, self.started_at))
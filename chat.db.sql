@@ -1,4 +1,6 @@
 -- Run: sqlite3 chat.db < chat.db.sql
+-- This is the baseline schema (version 0). Later schema changes live in
+-- migrations/ and are applied by app.py at startup or by: python3 manage.py migrate
 
 PRAGMA foreign_keys = ON;
 
@@ -0,0 +1,822 @@
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+
+# Pragmas applied to every pooled connection when it is opened. journal_mode=WAL
+# is persistent in the database file; the rest are per-connection settings.
+STORAGE_PROFILES = {
+    # WAL with full fsync on every commit: readers never block the writer and
+    # a committed message survives power loss.
+    'durable': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -16000,
+        'temp_store': 'DEFAULT',
+        'mmap_size': 0,
+    },
+    # WAL with fsync only at checkpoints: a crash can lose the last few commits
+    # but never corrupts the database. Larger cache and memory-mapped reads.
+    'throughput': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,
+        'temp_store': 'MEMORY',
+        'mmap_size': 268435456,
+    },
+    # SQLite defaults (rollback journal); kept as a baseline for benchmarks.
+    'rollback': {
+        'busy_timeout': 5000,
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+    },
+}
+
+
+def apply_profile(conn, profile):
+    """Apply a named storage profile's pragmas to an open connection"""
+    try:
+        pragmas = STORAGE_PROFILES[profile]
+    except KeyError:
+        raise ValueError(
+            f"Unknown storage profile {profile!r}; "
+            f"expected one of {', '.join(STORAGE_PROFILES)}"
+        )
+    for name, value in pragmas.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+
+
+def thread_offloader(async_mode, threads):
+    """Return a ``run(fn, *args, **kwargs)`` callable that executes blocking
+    calls on a bounded native thread pool for the given Socket.IO async mode,
+    or None when requests already run on their own threads"""
+    if async_mode == 'eventlet':
+        # tpool reads its size from the environment on first use
+        os.environ.setdefault('EVENTLET_THREADPOOL_SIZE', str(threads))
+        from eventlet import tpool
+        return tpool.execute
+    if async_mode == 'gevent':
+        import gevent
+        gevent.get_hub().threadpool.maxsize = threads
+
+        def run(fn, *args, **kwargs):
+            return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+        return run
+    return None
+
+
+class OffloadedConnection:
+    """Proxy that sends every method call on a connection, and on the cursors
+    it returns, through ``run`` so a slow query blocks a worker thread rather
+    than the event loop. Attribute reads such as ``lastrowid`` pass straight
+    through."""
+
+    def __init__(self, target, run):
+        self._target = target
+        self._run = run
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = self._run(attr, *args, **kwargs)
+            if isinstance(result, sqlite3.Cursor):
+                return OffloadedConnection(result, self._run)
+            return result
+        return call
+
+    def __iter__(self):
+        return iter(self._run(self._target.fetchall))
+
+
+class QueryTrace:
+    """One statement run through an InstrumentedConnection. ``seconds`` and
+    ``rows`` accumulate over the execute call and the fetches that follow;
+    ``calls`` counts them."""
+    __slots__ = ('sql', 'params', 'seconds', 'rows', 'calls')
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+        self.seconds = 0.0
+        self.rows = 0
+        self.calls = 0
+
+
+class _InstrumentedCursor:
+    def __init__(self, cursor, observe, trace):
+        self._cursor = cursor
+        self._observe = observe
+        self._trace = trace
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _fetch(self, fetch, args, count):
+        return _timed(self._observe, self._trace, fetch, args, count)
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone, (), lambda row: row is not None)
+
+    def fetchmany(self, *args):
+        return self._fetch(self._cursor.fetchmany, args, len)
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall, (), len)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+def _timed(observe, trace, fn, args, count=None):
+    """Run ``fn(*args)``, add its time and ``count(result)`` rows to ``trace``
+    and report the call"""
+    start = time.perf_counter()
+    rows = 0
+    try:
+        result = fn(*args)
+        rows = int(count(result)) if count else 0
+        return result
+    finally:
+        seconds = time.perf_counter() - start
+        trace.seconds += seconds
+        trace.rows += rows
+        trace.calls += 1
+        observe(trace, seconds, rows)
+
+
+class InstrumentedConnection:
+    """Proxy that times every statement run on a connection, including the
+    fetches that step through its results, and reports each call to
+    ``observe(trace, seconds, rows)``. The execute call and every later
+    fetch of one statement share a QueryTrace, so ``trace.calls == 1`` marks
+    a new statement. Commits are reported as the statement ``COMMIT``."""
+
+    def __init__(self, target, observe):
+        self._target = target
+        self._observe = observe
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+    def execute(self, sql, params=()):
+        trace = QueryTrace(sql, params)
+        cursor = _timed(self._observe, trace, self._target.execute, (sql, params))
+        return _InstrumentedCursor(cursor, self._observe, trace)
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        trace = QueryTrace(sql, seq_of_params)
+        cursor = _timed(self._observe, trace, self._target.executemany, (sql, seq_of_params))
+        return _InstrumentedCursor(cursor, self._observe, trace)
+
+    def commit(self):
+        return _timed(self._observe, QueryTrace('COMMIT', ()), self._target.commit, ())
+
+
+_WHITESPACE = re.compile(r'\s+')
+# "IN (?, ?, ?)" lists built for a variable number of ids
+_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def normalize_sql(sql):
+    """Collapse whitespace and placeholder lists so that every run of one
+    statement is grouped together"""
+    return _PLACEHOLDER_LIST.sub('(?, ...)', _WHITESPACE.sub(' ', sql).strip())
+
+
+def params_shape(params):
+    """Describe bound parameters by type only, e.g. ``(int, str)``"""
+    if isinstance(params, dict):
+        return '{' + ', '.join(f'{k}: {type(v).__name__}' for k, v in params.items()) + '}'
+    if isinstance(params, list) and params and isinstance(params[0], (tuple, list, dict)):
+        return f'{len(params)} x {params_shape(params[0])}'
+    if len(params) > 8:
+        return f'({len(params)} params)'
+    return '(' + ', '.join(type(p).__name__ for p in params) + ')'
+
+
+class QueryProfiler:
+    """``ConnectionPool.on_query`` hook that aggregates statements by their
+    normalized text (calls, total/max time, rows returned, parameter shapes)
+    and logs the ones slower than ``slow_threshold`` seconds.
+
+    A slow statement is logged once, when its execute and fetch time together
+    cross the threshold, as one JSON-ready dict passed to ``log`` with its
+    ``EXPLAIN QUERY PLAN``. Plans are read on a separate connection to
+    ``path`` and cached per statement. ``context()``, if given, labels each
+    slow entry (e.g. with the route being served). The last ``keep_slow``
+    entries are kept for ``report``.
+    """
+
+    def __init__(self, path, slow_threshold=0.1, log=None, context=None, keep_slow=50):
+        self.path = path
+        self.slow_threshold = slow_threshold
+        self.log = log
+        self.context = context
+        self._stats = {}
+        self._normalized = {}
+        self._plans = {}
+        self._slow = deque(maxlen=keep_slow)
+        self._lock = threading.Lock()
+        self._explain_conn = None
+        self._explain_lock = threading.Lock()
+        self.started_at = time.time()
+
+    def __call__(self, trace, seconds, rows):
+        sql = self._normalized.get(trace.sql)
+        if sql is None:
+            sql = normalize_sql(trace.sql)
+            if len(self._normalized) < 10000:
+                self._normalized[trace.sql] = sql
+        with self._lock:
+            stats = self._stats.get(sql)
+            if stats is None:
+                stats = self._stats[sql] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                            'rows': 0, 'slow': 0, 'shapes': set(),
+                                            'sample': (trace.sql, trace.params)}
+            if trace.calls == 1:
+                stats['calls'] += 1
+                if len(stats['shapes']) < 5:
+                    stats['shapes'].add(params_shape(trace.params))
+            stats['seconds'] += seconds
+            stats['rows'] += rows
+            stats['max_seconds'] = max(stats['max_seconds'], trace.seconds)
+            crossed = (self.slow_threshold
+                       and trace.seconds >= self.slow_threshold > trace.seconds - seconds)
+            if crossed:
+                stats['slow'] += 1
+
+        if crossed:
+            entry = {
+                'at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'ms': round(trace.seconds * 1000, 3),
+                'rows': trace.rows,
+                'sql': sql,
+                'params': params_shape(trace.params),
+                'context': self.context() if self.context else None,
+                'plan': self.explain(sql, trace.sql, trace.params),
+            }
+            with self._lock:
+                self._slow.append(entry)
+            if self.log:
+                self.log(entry)
+
+    def explain(self, sql, raw_sql, params):
+        """EXPLAIN QUERY PLAN lines for a statement, or None if it has none"""
+        if not sql.upper().startswith(_EXPLAINABLE):
+            return None
+        with self._lock:
+            if sql in self._plans:
+                return self._plans[sql]
+        if isinstance(params, list):
+            params = params[0] if params else ()
+        with self._explain_lock:
+            try:
+                if self._explain_conn is None:
+                    self._explain_conn = sqlite3.connect(self.path, check_same_thread=False)
+                plan = [row[3] for row in self._explain_conn.execute(
+                    'EXPLAIN QUERY PLAN ' + raw_sql, params)]
+            except sqlite3.Error as e:
+                plan = [f'(EXPLAIN failed: {e})']
+        with self._lock:
+            self._plans[sql] = plan
+        return plan
+
+    def report(self, limit=20, order='seconds'):
+        """Top ``limit`` statements by total time (``order='seconds'``),
+        ``'calls'``, ``'max_seconds'`` or ``'rows'``, each with its query
+        plan, plus the most recent slow statements"""
+        with self._lock:
+            stats = [(sql, dict(s, shapes=sorted(s['shapes']))) for sql, s in self._stats.items()]
+            slow = list(self._slow)
+        total = sum(s['seconds'] for _, s in stats) or 1.0
+        stats.sort(key=lambda item: item[1][order], reverse=True)
+        return {
+            'since': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started_at)),
+            'statements': len(stats),
+            'slow_threshold_ms': round(self.slow_threshold * 1000, 3),
+            'top': [{
+                'sql': sql,
+                'calls': s['calls'],
+                'total_ms': round(s['seconds'] * 1000, 3),
+                'share': round(s['seconds'] / total, 3),
+                'mean_ms': round(s['seconds'] * 1000 / s['calls'], 3) if s['calls'] else 0.0,
+                'max_ms': round(s['max_seconds'] * 1000, 3),
+                'rows': s['rows'],
+                'rows_per_call': round(s['rows'] / s['calls'], 2) if s['calls'] else 0.0,
+                'slow': s['slow'],
+                'params': s['shapes'],
+                'plan': self.explain(sql, *s['sample']),
+            } for sql, s in stats[:limit]],
+            'recent_slow': slow[::-1],
+        }
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._slow.clear()
+            self.started_at = time.time()
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """Raised when no pooled connection frees up within the checkout timeout"""
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections shared by REST routes and socket handlers.
+
+    Connections are opened lazily up to ``size``; pragma setup (foreign keys and
+    the storage profile) runs once when a connection is opened rather than on
+    every checkout. Idle connections are probed with ``SELECT 1`` before reuse
+    once they have sat unused for longer than ``health_check_interval``
+    seconds, and broken ones are replaced.
+
+    Callables appended to ``on_connect`` are invoked with each newly opened
+    connection, e.g. to install trace callbacks. With ``offload`` (see
+    ``thread_offloader``) connections are handed out wrapped in an
+    ``OffloadedConnection``. Callables appended to ``on_query`` before the
+    first checkout receive every statement's timings (see
+    ``InstrumentedConnection``); they run on the calling thread.
+    """
+
+    def __init__(self, path, size=8, timeout=5.0, health_check_interval=30.0,
+                 profile='durable', offload=None):
+        if profile not in STORAGE_PROFILES:
+            raise ValueError(f'Unknown storage profile {profile!r}')
+        self.path = path
+        self.profile = profile
+        self.offload = offload
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.on_connect = []
+        self.on_query = []
+
+        # LIFO keeps the hottest connections (and their page cache) in use
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._in_use = 0
+
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+        self._peak_in_use = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA foreign_keys = ON')
+        apply_profile(conn, self.profile)
+        for hook in self.on_connect:
+            hook(conn)
+        if self.offload:
+            conn = OffloadedConnection(conn, self.offload)
+        if self.on_query:
+            conn = InstrumentedConnection(conn, self._report_query)
+        return conn
+
+    def _report_query(self, trace, seconds, rows):
+        for hook in self.on_query:
+            hook(trace, seconds, rows)
+
+    def _reserve_slot(self):
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                return True
+            return False
+
+    def _discard(self, conn):
+        with self._lock:
+            self._opened -= 1
+            self._discarded += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _healthy(self, conn, last_used):
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        """Check out a connection, waiting up to ``timeout`` seconds if saturated"""
+        start = time.perf_counter()
+        waited = False
+
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                if self._reserve_slot():
+                    try:
+                        conn = self._connect()
+                    except sqlite3.Error:
+                        with self._lock:
+                            self._opened -= 1
+                        raise
+                    break
+
+                waited = True
+                remaining = self.timeout - (time.perf_counter() - start)
+                try:
+                    if remaining <= 0:
+                        raise queue.Empty
+                    conn, last_used = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise PoolTimeout(
+                        f'No database connection available after {self.timeout}s'
+                    )
+
+            if self._healthy(conn, last_used):
+                break
+            self._discard(conn)
+
+        wait = time.perf_counter() - start
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+            if waited:
+                self._waits += 1
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+        return conn
+
+    def release(self, conn):
+        """Return a connection to the pool, rolling back any open transaction"""
+        with self._lock:
+            self._in_use -= 1
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put((conn, time.monotonic()))
+
+    def close_all(self):
+        """Close every idle connection (used on shutdown and by benchmarks)"""
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._opened -= 1
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'profile': self.profile,
+                'size': self.size,
+                'open': self._opened,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize(),
+                'peak_in_use': self._peak_in_use,
+                'saturation': round(self._in_use / self.size, 3) if self.size else 0.0,
+                'checkouts': self._checkouts,
+                'waited_checkouts': self._waits,
+                'wait_time_total_ms': round(self._wait_total * 1000, 3),
+                'wait_time_max_ms': round(self._wait_max * 1000, 3),
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+            }
+
+
+class _PendingWrite:
+    __slots__ = ('item', 'result', 'error', 'done')
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """Funnels writes from many callers through one writer that commits them
+    in group transactions, so a burst of messages shares one fsync.
+
+    ``write(conn, item)`` runs for each submitted item inside the batch's
+    transaction (under its own savepoint, so a failing item only rolls back
+    itself) and returns that item's result. A batch is committed once it holds
+    ``max_batch`` items or ``max_delay`` seconds after its first item arrived;
+    with ``max_delay=0`` it takes whatever queued up while the previous batch
+    was being written. ``submit`` returns only after the batch containing the
+    item is committed. ``on_commit(results)`` then runs with the results of the
+    batch, e.g. to broadcast them.
+
+    ``spawn`` starts the writer loop (default: a daemon thread); pass the
+    server's background task starter under eventlet/gevent.
+    """
+
+    def __init__(self, pool, write, on_commit=None, max_batch=64, max_delay=0.0,
+                 spawn=None):
+        self.pool = pool
+        self.write = write
+        self.on_commit = on_commit
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.spawn = spawn
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+        self._batches = 0
+        self._items = 0
+        self._largest = 0
+        self._failed_batches = 0
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        if self.spawn:
+            self.spawn(self._run)
+        else:
+            threading.Thread(target=self._run, name='group-commit', daemon=True).start()
+
+    def submit(self, item):
+        """Queue ``item`` and wait until it is committed; returns the result of
+        ``write`` or raises its exception"""
+        self._start()
+        pending = _PendingWrite(item)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                if self.max_delay:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            committed = False
+            try:
+                self._flush(batch)
+                committed = True
+            except Exception as e:
+                with self._lock:
+                    self._failed_batches += 1
+                for pending in batch:
+                    pending.result, pending.error = None, e
+            finally:
+                for pending in batch:
+                    pending.done.set()
+
+            if self.on_commit and committed:
+                try:
+                    self.on_commit([p.result for p in batch if p.error is None])
+                except Exception as e:
+                    print(f'Group commit callback failed: {e}')
+
+    def _flush(self, batch):
+        conn = self.pool.acquire()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for pending in batch:
+                conn.execute('SAVEPOINT item')
+                try:
+                    pending.result = self.write(conn, pending.item)
+                    conn.execute('RELEASE item')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO item')
+                    conn.execute('RELEASE item')
+                    pending.error = e
+            conn.commit()
+        finally:
+            self.pool.release(conn)
+
+        with self._lock:
+            self._batches += 1
+            self._items += len(batch)
+            self._largest = max(self._largest, len(batch))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_batch': self.max_batch,
+                'max_delay_ms': round(self.max_delay * 1000, 3),
+                'queued': self._queue.qsize(),
+                'batches': self._batches,
+                'items': self._items,
+                'mean_batch': round(self._items / self._batches, 2) if self._batches else 0.0,
+                'largest_batch': self._largest,
+                'failed_batches': self._failed_batches,
+            }
+
+
+class WriteBehindBuffer:
+    """Holds writes keyed by ``key`` in memory and lets one background writer
+    apply them every ``interval`` seconds, so repeated writes to the same key
+    (e.g. a reader's position in a conversation) cost one row update per
+    interval instead of one transaction per request.
+
+    ``put(key, value)`` combines the value with any pending one through
+    ``merge(old, new)`` (default: keep the new one). Each flush runs
+    ``write(conn, key, value)`` for every buffered key inside one transaction,
+    each under its own savepoint, and ``on_commit(items)`` runs with the
+    written ``(key, value)`` pairs after it has committed. Until then
+    ``get(key)`` returns the buffered value so callers can overlay it on what
+    the database says. A key whose write fails is rolled back alone and
+    retried on the next flush; after ``max_attempts`` failures in a row it is
+    logged and dropped so it cannot hold up the others. If the transaction
+    itself fails (e.g. the database is busy) the whole batch is retried.
+
+    Buffered writes live only in this process: they are lost if it dies
+    before a flush, and other workers do not see them.
+    """
+
+    def __init__(self, pool, write, on_commit=None, interval=0.2, merge=None, spawn=None,
+                 max_attempts=5):
+        self.pool = pool
+        self.write = write
+        self.on_commit = on_commit
+        self.interval = interval
+        self.merge = merge or (lambda old, new: new)
+        self.spawn = spawn
+        self.max_attempts = max_attempts
+        self._pending = {}
+        self._inflight = {}
+        # Consecutive failed writes per key
+        self._attempts = {}
+        self._lock = threading.Lock()
+        # Keeps the background flush and an explicit flush() from interleaving
+        self._flush_lock = threading.Lock()
+        self._started = False
+
+        self._puts = 0
+        self._flushes = 0
+        self._items = 0
+        self._failed_flushes = 0
+        self._failed_items = 0
+        self._dropped = 0
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        if self.spawn:
+            self.spawn(self._run)
+        else:
+            threading.Thread(target=self._run, name='write-behind', daemon=True).start()
+
+    def _requeue(self, items):
+        """Put (key, value) pairs back in front of anything put since; call
+        with the lock held"""
+        for key, value in items:
+            if key in self._pending:
+                value = self.merge(value, self._pending[key])
+            self._pending[key] = value
+
+    def put(self, key, value):
+        self._start()
+        with self._lock:
+            self._puts += 1
+            if key in self._pending:
+                value = self.merge(self._pending[key], value)
+            self._pending[key] = value
+
+    def get(self, key):
+        """The value buffered for ``key`` but not yet committed, or None"""
+        with self._lock:
+            pending = self._pending.get(key)
+            inflight = self._inflight.get(key)
+        if pending is None or inflight is None:
+            return inflight if pending is None else pending
+        return self.merge(inflight, pending)
+
+    def items(self):
+        """Every buffered (key, value) pair not yet committed"""
+        with self._lock:
+            merged = dict(self._inflight)
+            for key, value in self._pending.items():
+                merged[key] = self.merge(merged[key], value) if key in merged else value
+        return list(merged.items())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'Write-behind flush failed: {e}')
+
+    def flush(self):
+        """Write everything buffered so far; returns the number of keys written"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, {}
+                self._inflight = batch
+
+            written, failed = [], []
+            try:
+                conn = self.pool.acquire()
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    for key, value in batch.items():
+                        conn.execute('SAVEPOINT item')
+                        try:
+                            self.write(conn, key, value)
+                            conn.execute('RELEASE item')
+                            written.append((key, value))
+                        except Exception as e:
+                            conn.execute('ROLLBACK TO item')
+                            conn.execute('RELEASE item')
+                            failed.append((key, value, e))
+                    conn.commit()
+                finally:
+                    self.pool.release(conn)
+            except Exception:
+                with self._lock:
+                    self._failed_flushes += 1
+                    self._requeue(batch.items())
+                    self._inflight = {}
+                raise
+
+            with self._lock:
+                self._inflight = {}
+                self._flushes += 1
+                self._items += len(written)
+                for key, _ in written:
+                    self._attempts.pop(key, None)
+                retry = []
+                for key, value, error in failed:
+                    self._failed_items += 1
+                    attempts = self._attempts.get(key, 0) + 1
+                    if attempts < self.max_attempts:
+                        self._attempts[key] = attempts
+                        retry.append((key, value))
+                        print(f'Write-behind write for {key!r} failed '
+                              f'(attempt {attempts} of {self.max_attempts}): {error}')
+                    else:
+                        self._attempts.pop(key, None)
+                        self._dropped += 1
+                        print(f'Write-behind write for {key!r} failed {attempts} times, '
+                              f'dropping {value!r}: {error}')
+                self._requeue(retry)
+
+        if self.on_commit and written:
+            try:
+                self.on_commit(written)
+            except Exception as e:
+                print(f'Write-behind callback failed: {e}')
+        return len(written)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'interval_ms': round(self.interval * 1000, 3),
+                'pending': len(self._pending) + len(self._inflight),
+                'puts': self._puts,
+                'flushes': self._flushes,
+                'items': self._items,
+                'coalesced': (self._puts - self._items - self._dropped
+                              - len(self._pending) - len(self._inflight)),
+                'mean_batch': round(self._items / self._flushes, 2) if self._flushes else 0.0,
+                'failed_flushes': self._failed_flushes,
+                'failed_items': self._failed_items,
+                'dropped': self._dropped,
+            }
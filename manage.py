@@ -0,0 +1,239 @@
+"""Maintenance commands for the chat database.
+
+Usage: python3 manage.py <command> [options]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+
+import migrate
+import seed
+
+DEFAULT_DB = os.environ.get('CHAT_DB', 'chat.db')
+DEFAULT_READ_MODEL = os.environ.get('CHAT_READ_MODEL', 'receipts')
+
+# Ground truth for conversation_unread under each read model
+EXPECTED_UNREAD = {
+    'receipts': '''
+        SELECT cm.user_id, cm.conversation_id,
+               (SELECT COUNT(*) FROM messages m
+                LEFT JOIN message_reads mr ON mr.message_id = m.id AND mr.user_id = cm.user_id
+                WHERE m.conversation_id = cm.conversation_id
+                  AND m.sender_id != cm.user_id AND mr.message_id IS NULL) AS count,
+               COALESCE((SELECT MAX(mr.message_id) FROM message_reads mr
+                         JOIN messages m ON m.id = mr.message_id
+                         WHERE mr.user_id = cm.user_id
+                           AND m.conversation_id = cm.conversation_id), 0) AS last_read_message_id
+        FROM conversation_members cm
+    ''',
+    'watermark': '''
+        SELECT cm.user_id, cm.conversation_id,
+               (SELECT COUNT(*) FROM messages m
+                WHERE m.conversation_id = cm.conversation_id
+                  AND m.sender_id != cm.user_id
+                  AND m.id > cm.last_read_message_id) AS count,
+               cm.last_read_message_id
+        FROM conversation_members cm
+    ''',
+}
+
+# A member's watermark is the id just below their oldest unread message, or
+# the newest message in the conversation if they have read everything.
+WATERMARKS_FROM_RECEIPTS = '''
+    SELECT COALESCE(
+               (SELECT MIN(m.id) - 1 FROM messages m
+                LEFT JOIN message_reads mr ON mr.message_id = m.id AND mr.user_id = cm.user_id
+                WHERE m.conversation_id = cm.conversation_id
+                  AND m.sender_id != cm.user_id AND mr.message_id IS NULL),
+               (SELECT MAX(m.id) FROM messages m
+                WHERE m.conversation_id = cm.conversation_id),
+               0) AS watermark,
+           cm.conversation_id, cm.user_id
+    FROM conversation_members cm
+'''
+
+
+def connect(path):
+    if not os.path.exists(path):
+        sys.exit(f'Database {path} not found')
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+
+def migrate_schema(args):
+    """Apply pending schema migrations from migrations/"""
+    conn = connect(args.db)
+    if args.status:
+        done = migrate.applied_versions(conn)
+        for migration in migrate.discover():
+            state = 'applied' if migration.version in done else 'pending'
+            print(f'{migration.version:04d}_{migration.name}: {state}')
+    else:
+        applied = migrate.apply(conn, target=args.target)
+        print(f'{len(applied)} migration(s) applied')
+    conn.close()
+
+
+def reconcile_unread(args):
+    """Rebuild conversation_unread from messages/message_reads and report drift"""
+    conn = connect(args.db)
+
+    stored = {
+        (row['user_id'], row['conversation_id']): row['count']
+        for row in conn.execute('SELECT user_id, conversation_id, count FROM conversation_unread')
+    }
+    expected = conn.execute(EXPECTED_UNREAD[args.read_model]).fetchall()
+
+    drift = 0
+    for row in expected:
+        key = (row['user_id'], row['conversation_id'])
+        actual = stored.pop(key, 0)
+        if actual != row['count']:
+            drift += 1
+            print(f'drift: user {key[0]} in {key[1]}: stored {actual}, expected {row["count"]}')
+    for (user_id, conversation_id), count in stored.items():
+        if count:
+            drift += 1
+            print(f'drift: user {user_id} is not a member of {conversation_id} '
+                  f'but has {count} unread')
+
+    print(f'{len(expected)} counters checked, {drift} drifted')
+
+    if args.fix:
+        with conn:
+            conn.execute('DELETE FROM conversation_unread')
+            conn.executemany('''
+                INSERT INTO conversation_unread
+                    (user_id, conversation_id, count, last_read_message_id)
+                VALUES (?, ?, ?, ?)
+            ''', expected)
+        print('conversation_unread rebuilt')
+    conn.close()
+
+    if drift and not args.fix:
+        sys.exit(1)
+
+
+def migrate_reads(args):
+    """Convert message_reads receipts into per-member read watermarks and
+    rebuild conversation_unread to match"""
+    conn = connect(args.db)
+    if migrate.pending(conn):
+        sys.exit('Schema is out of date; run: python3 manage.py migrate')
+
+    written = 0
+    for first, last in migrate.rowid_ranges(conn, 'conversation_members', args.chunk_size):
+        with conn:
+            watermarks = conn.execute(
+                WATERMARKS_FROM_RECEIPTS + ' WHERE cm.rowid BETWEEN ? AND ?', (first, last)
+            ).fetchall()
+            conn.executemany('''
+                UPDATE conversation_members SET last_read_message_id = ?
+                WHERE conversation_id = ? AND user_id = ?
+            ''', watermarks)
+            # The unread counters (and the position mark-as-read compares
+            # against) must follow the new watermarks
+            conn.executemany('''
+                INSERT OR REPLACE INTO conversation_unread
+                    (user_id, conversation_id, count, last_read_message_id)
+                VALUES (?, ?, ?, ?)
+            ''', conn.execute(
+                EXPECTED_UNREAD['watermark'] + ' WHERE cm.rowid BETWEEN ? AND ?', (first, last)
+            ).fetchall())
+        written += len(watermarks)
+    print(f'{written} watermarks written, conversation_unread rebuilt from them')
+
+    # Receipts for messages read out of order cannot be expressed as a watermark
+    lost = conn.execute('''
+        SELECT COUNT(*) FROM message_reads mr
+        JOIN messages m ON m.id = mr.message_id
+        JOIN conversation_members cm
+          ON cm.conversation_id = m.conversation_id AND cm.user_id = mr.user_id
+        WHERE mr.message_id > cm.last_read_message_id
+    ''').fetchone()[0]
+    if lost:
+        print(f'{lost} receipts lie above their reader\'s watermark and will show as unread')
+
+    if args.drop_receipts:
+        with conn:
+            dropped = conn.execute('DELETE FROM message_reads').rowcount
+        print(f'{dropped} message_reads rows deleted')
+    conn.close()
+    print('Start the app with CHAT_READ_MODEL=watermark to use the watermarks')
+
+
+def seed_data(args):
+    """Add a generated dataset (users, conversations, messages, reads) for load testing"""
+    if os.path.exists(args.db):
+        conn = connect(args.db)
+    else:
+        print(f'Creating {args.db} from chat.db.sql')
+        conn = seed.create(args.db)
+    try:
+        counts = seed.populate(
+            conn, users=args.users, dms=args.dms, groups=args.groups,
+            messages=args.messages, group_size_min=args.group_size_min,
+            group_size_max=args.group_size_max, group_size_alpha=args.group_size_alpha,
+            days=args.days, read_ratio=args.read_ratio,
+            receipts=args.read_model == 'receipts', seed=args.seed)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    finally:
+        conn.close()
+    print(', '.join(f'{count} {table}' for table, count in counts.items()) + ' added')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default=DEFAULT_DB,
+                        help='database path (default: $CHAT_DB or chat.db)')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('migrate', help=migrate_schema.__doc__)
+    p.add_argument('--status', action='store_true',
+                   help='list migrations and whether they have been applied')
+    p.add_argument('--target', type=int,
+                   help='stop after this migration version')
+    p.set_defaults(func=migrate_schema)
+
+    p = sub.add_parser('reconcile-unread', help=reconcile_unread.__doc__)
+    p.add_argument('--fix', action='store_true',
+                   help='rewrite the counters instead of only reporting drift')
+    p.add_argument('--read-model', choices=sorted(EXPECTED_UNREAD), default=DEFAULT_READ_MODEL,
+                   help='read model the app runs with (default: $CHAT_READ_MODEL or receipts)')
+    p.set_defaults(func=reconcile_unread)
+
+    p = sub.add_parser('migrate-reads', help=migrate_reads.__doc__)
+    p.add_argument('--drop-receipts', action='store_true',
+                   help='delete message_reads rows once the watermarks are written')
+    p.add_argument('--chunk-size', type=int, default=migrate.CHUNK_SIZE,
+                   help='members updated per transaction')
+    p.set_defaults(func=migrate_reads)
+
+    p = sub.add_parser('seed', help=seed_data.__doc__)
+    p.add_argument('--users', type=int, default=1000)
+    p.add_argument('--dms', type=int, default=2000, help='direct conversations')
+    p.add_argument('--groups', type=int, default=200, help='group conversations')
+    p.add_argument('--group-size-min', type=int, default=3)
+    p.add_argument('--group-size-max', type=int, default=500)
+    p.add_argument('--group-size-alpha', type=float, default=1.2,
+                   help='Pareto shape of group sizes; lower means more large groups')
+    p.add_argument('--messages', type=int, default=100000)
+    p.add_argument('--days', type=int, default=90, help='time span the messages cover')
+    p.add_argument('--read-ratio', type=float, default=0.8,
+                   help='share of members who have read their whole conversation')
+    p.add_argument('--read-model', choices=sorted(EXPECTED_UNREAD), default=DEFAULT_READ_MODEL,
+                   help='watermark skips writing message_reads receipts '
+                        '(default: $CHAT_READ_MODEL or receipts)')
+    p.add_argument('--seed', type=int, default=0, help='random seed')
+    p.set_defaults(func=seed_data)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
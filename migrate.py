@@ -0,0 +1,132 @@
+"""Versioned schema migrations for the chat database.
+
+chat.db.sql creates the baseline schema (version 0). Every later schema change
+is a numbered file in migrations/, either ``NNNN_description.sql`` or
+``NNNN_description.py``, applied in order; the schema_version table records
+which ones have run.
+
+SQL migrations run inside a single transaction together with their
+schema_version row. Python migrations define ``upgrade(conn)`` and may commit
+as they go, which lets long backfills work through a table in chunks (see
+``rowid_ranges``) instead of holding the write lock for the whole run. They
+must therefore be safe to re-run if interrupted.
+"""
+import importlib.util
+import os
+import re
+import sqlite3
+from collections import namedtuple
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+CHUNK_SIZE = int(os.environ.get('CHAT_MIGRATION_CHUNK_SIZE', 5000))
+
+Migration = namedtuple('Migration', 'version name path')
+
+_FILENAME = re.compile(r'^(\d{4})_(\w+)\.(sql|py)$')
+
+
+def discover(directory=MIGRATIONS_DIR):
+    """Return the migrations in ``directory`` sorted by version"""
+    migrations = {}
+    for filename in sorted(os.listdir(directory)):
+        match = _FILENAME.match(filename)
+        if not match:
+            continue
+        version = int(match.group(1))
+        if version in migrations:
+            raise ValueError(f'Duplicate migration version {version:04d}')
+        migrations[version] = Migration(version, match.group(2),
+                                        os.path.join(directory, filename))
+    return [migrations[v] for v in sorted(migrations)]
+
+
+def ensure_version_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+
+def applied_versions(conn):
+    ensure_version_table(conn)
+    return {row[0] for row in conn.execute('SELECT version FROM schema_version')}
+
+
+def pending(conn, directory=MIGRATIONS_DIR):
+    done = applied_versions(conn)
+    return [m for m in discover(directory) if m.version not in done]
+
+
+def rowid_ranges(conn, table, chunk_size=None):
+    """Yield inclusive (first, last) rowid bounds that cover ``table`` in chunks"""
+    chunk_size = chunk_size or CHUNK_SIZE
+    low, high = conn.execute(f'SELECT MIN(rowid), MAX(rowid) FROM {table}').fetchone()
+    if low is None:
+        return
+    for start in range(low, high + 1, chunk_size):
+        yield start, start + chunk_size - 1
+
+
+def split_statements(script):
+    """Split an SQL script into complete statements"""
+    statements, buffer = [], ''
+    for line in script.splitlines(keepends=True):
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            statements.append(buffer.strip())
+            buffer = ''
+    if buffer.strip() and not all(
+        l.strip().startswith('--') or not l.strip() for l in buffer.splitlines()
+    ):
+        raise ValueError(f'Incomplete SQL statement: {buffer.strip()[:60]}')
+    return statements
+
+
+def _record(conn, migration):
+    conn.execute('INSERT OR IGNORE INTO schema_version (version, name) VALUES (?, ?)',
+                 (migration.version, migration.name))
+
+
+def _run_sql(conn, migration):
+    with open(migration.path) as f:
+        statements = split_statements(f.read())
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for statement in statements:
+            conn.execute(statement)
+        _record(conn, migration)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _run_python(conn, migration):
+    spec = importlib.util.spec_from_file_location(
+        f'migration_{migration.version:04d}', migration.path
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.upgrade(conn)
+    _record(conn, migration)
+    conn.commit()
+
+
+def apply(conn, target=None, directory=MIGRATIONS_DIR, log=print):
+    """Apply pending migrations up to ``target`` (default: all). Returns the
+    migrations that were applied."""
+    applied = []
+    for migration in pending(conn, directory):
+        if target is not None and migration.version > target:
+            break
+        log(f'Applying migration {migration.version:04d}_{migration.name}...')
+        if migration.path.endswith('.sql'):
+            _run_sql(conn, migration)
+        else:
+            _run_python(conn, migration)
+        applied.append(migration)
+    return applied
@@ -0,0 +1,40 @@
+"""Materialized per-user unread counters, backfilled from message_reads.
+
+The backfill works through conversation_members in rowid chunks and commits
+after each one, so writers are never blocked for the whole table.
+"""
+from migrate import rowid_ranges
+
+
+def upgrade(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_unread (
+            user_id INTEGER NOT NULL,
+            conversation_id TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            last_read_message_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, conversation_id),
+            FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    ''')
+    conn.commit()
+
+    for first, last in rowid_ranges(conn, 'conversation_members'):
+        conn.execute('''
+            INSERT OR REPLACE INTO conversation_unread
+                (user_id, conversation_id, count, last_read_message_id)
+            SELECT cm.user_id, cm.conversation_id,
+                   (SELECT COUNT(*) FROM messages m
+                    LEFT JOIN message_reads mr
+                           ON mr.message_id = m.id AND mr.user_id = cm.user_id
+                    WHERE m.conversation_id = cm.conversation_id
+                      AND m.sender_id != cm.user_id AND mr.message_id IS NULL),
+                   COALESCE((SELECT MAX(mr.message_id) FROM message_reads mr
+                             JOIN messages m ON m.id = mr.message_id
+                             WHERE mr.user_id = cm.user_id
+                               AND m.conversation_id = cm.conversation_id), 0)
+            FROM conversation_members cm
+            WHERE cm.rowid BETWEEN ? AND ?
+        ''', (first, last))
+        conn.commit()
@@ -0,0 +1,17 @@
+"""Per-member read watermark, used when CHAT_READ_MODEL=watermark.
+
+Existing receipts are converted separately by: python3 manage.py migrate-reads
+"""
+
+
+def upgrade(conn):
+    # Hold the write lock from the check to the ALTER, so a second process
+    # migrating at the same time sees the column instead of adding it again
+    conn.execute('BEGIN IMMEDIATE')
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(conversation_members)')}
+    if 'last_read_message_id' not in columns:
+        conn.execute('''
+            ALTER TABLE conversation_members
+            ADD COLUMN last_read_message_id INTEGER NOT NULL DEFAULT 0
+        ''')
+    conn.commit()
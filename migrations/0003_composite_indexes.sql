@@ -0,0 +1,18 @@
+-- Composite indexes for the hot access patterns.
+--
+-- History pages use messages(conversation_id, id). The baseline
+-- idx_messages_conversation on messages(conversation_id) already has that
+-- layout because SQLite appends the rowid to every index key.
+
+-- "Which conversations is this user in" (conversation list, socket auth);
+-- the primary key only serves lookups by conversation_id first.
+CREATE INDEX IF NOT EXISTS idx_members_user
+    ON conversation_members(user_id, conversation_id);
+
+-- "Which messages has this user read"; lookups by (message_id, user_id) use
+-- the primary key, which also makes a message_id-only index redundant.
+CREATE INDEX IF NOT EXISTS idx_reads_user_message
+    ON message_reads(user_id, message_id);
+
+DROP INDEX IF EXISTS idx_reads_user;
+DROP INDEX IF EXISTS idx_reads_message;
@@ -0,0 +1,25 @@
+-- A counter bumped by every change to users. Processes caching user profiles
+-- (UserDirectory in cache.py) poll this one row to learn that their copy is
+-- stale, whichever process or tool made the change.
+
+CREATE TABLE IF NOT EXISTS users_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO users_version (id, version) VALUES (1, 0);
+
+CREATE TRIGGER IF NOT EXISTS users_version_insert AFTER INSERT ON users
+BEGIN
+    UPDATE users_version SET version = version + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_version_update AFTER UPDATE ON users
+BEGIN
+    UPDATE users_version SET version = version + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_version_delete AFTER DELETE ON users
+BEGIN
+    UPDATE users_version SET version = version + 1 WHERE id = 1;
+END;
@@ -0,0 +1,71 @@
+"""Full-text index over messages.content for GET /search.
+
+messages_fts is an external-content FTS5 table: it stores only the index and
+reads the text from messages, and triggers keep it in sync. The backfill of
+existing messages runs in rowid chunks, committing after each one, and skips
+messages that are already indexed, so it can be re-run or run by two
+processes at once.
+"""
+from migrate import rowid_ranges
+
+TRIGGERS = (
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+    BEGIN
+        INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+    BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages
+    BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    ''',
+)
+
+
+def upgrade(conn):
+    # Create the index and its triggers in one transaction that holds the write
+    # lock from the check on, so a second process migrating at the same time
+    # finds them instead of creating them again. Messages written from then on
+    # are indexed by the triggers.
+    conn.execute('BEGIN IMMEDIATE')
+    exists = conn.execute('''
+        SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'
+    ''').fetchone()
+    if not exists:
+        conn.execute('''
+            CREATE VIRTUAL TABLE messages_fts USING fts5(
+                content,
+                content = 'messages',
+                content_rowid = 'id',
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        ''')
+    for statement in TRIGGERS:
+        conn.execute(statement)
+    conn.commit()
+
+    # Index only the messages that are not in the index yet (it has a
+    # messages_fts_docsize row for every indexed one): rows the triggers
+    # indexed, chunks done by an interrupted run or by another process
+    # backfilling concurrently are skipped, as indexing a row twice would
+    # corrupt an external-content index
+    for first, last in rowid_ranges(conn, 'messages'):
+        conn.execute('''
+            INSERT INTO messages_fts (rowid, content)
+            SELECT id, content FROM messages
+            WHERE id BETWEEN :first AND :last
+              AND id NOT IN (SELECT id FROM messages_fts_docsize
+                             WHERE id BETWEEN :first AND :last)
+        ''', {'first': first, 'last': last})
+        conn.commit()
@@ -0,0 +1,44 @@
+"""Per-message read counter for the receipts read model.
+
+messages.read_count holds the number of message_reads rows for the message,
+kept current by triggers on message_reads, so message listings and
+GET /messages/<id>/reads need no aggregate over the receipts. The backfill
+recounts existing messages in rowid chunks; each chunk sets absolute counts
+inside its own transaction, so it agrees with the triggers whatever order
+they run in, and re-running it is harmless.
+"""
+from migrate import rowid_ranges
+
+TRIGGERS = (
+    '''
+    CREATE TRIGGER IF NOT EXISTS message_reads_count_insert AFTER INSERT ON message_reads
+    BEGIN
+        UPDATE messages SET read_count = read_count + 1 WHERE id = new.message_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS message_reads_count_delete AFTER DELETE ON message_reads
+    BEGIN
+        UPDATE messages SET read_count = read_count - 1 WHERE id = old.message_id;
+    END
+    ''',
+)
+
+
+def upgrade(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(messages)')}
+    if 'read_count' not in columns:
+        conn.execute('ALTER TABLE messages ADD COLUMN read_count INTEGER NOT NULL DEFAULT 0')
+    for statement in TRIGGERS:
+        conn.execute(statement)
+    conn.commit()
+
+    for first, last in rowid_ranges(conn, 'messages'):
+        conn.execute('''
+            UPDATE messages SET read_count = (
+                SELECT COUNT(*) FROM message_reads WHERE message_id = messages.id
+            )
+            WHERE id BETWEEN ? AND ?
+        ''', (first, last))
+        conn.commit()
@@ -0,0 +1,97 @@
+-- Change counters behind the ETag/Last-Modified validators of
+-- GET /conversations (scope 'user', one row per user) and
+-- GET /conversations/<id>/members (scope 'conversation'). Triggers bump them
+-- on every change to the rows those responses are built from, so a change
+-- made by any process or tool (another worker, manage.py, the sqlite3 shell)
+-- invalidates the tags. changed_at is in Unix seconds, for Last-Modified.
+-- Changes to users are covered by users_version (0004).
+
+CREATE TABLE IF NOT EXISTS change_counters (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    changed_at REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (scope, key)
+) WITHOUT ROWID;
+
+-- Unread counts: bumped by every new message and every read
+CREATE TRIGGER IF NOT EXISTS change_counters_unread_insert AFTER INSERT ON conversation_unread
+BEGIN
+    INSERT INTO change_counters (scope, key, version, changed_at)
+    VALUES ('user', new.user_id, 1, (julianday('now') - 2440587.5) * 86400.0)
+    ON CONFLICT (scope, key) DO UPDATE
+    SET version = version + 1, changed_at = excluded.changed_at;
+END;
+
+CREATE TRIGGER IF NOT EXISTS change_counters_unread_update AFTER UPDATE ON conversation_unread
+BEGIN
+    INSERT INTO change_counters (scope, key, version, changed_at)
+    VALUES ('user', new.user_id, 1, (julianday('now') - 2440587.5) * 86400.0)
+    ON CONFLICT (scope, key) DO UPDATE
+    SET version = version + 1, changed_at = excluded.changed_at;
+END;
+
+CREATE TRIGGER IF NOT EXISTS change_counters_unread_delete AFTER DELETE ON conversation_unread
+BEGIN
+    INSERT INTO change_counters (scope, key, version, changed_at)
+    VALUES ('user', old.user_id, 1, (julianday('now') - 2440587.5) * 86400.0)
+    ON CONFLICT (scope, key) DO UPDATE
+    SET version = version + 1, changed_at = excluded.changed_at;
+END;
+
+-- Membership: the conversation's member list, and the conversation list of
+-- every member (which shows member counts and direct chat names)
+CREATE TRIGGER IF NOT EXISTS change_counters_members_insert AFTER INSERT ON conversation_members
+BEGIN
+    INSERT INTO change_counters (scope, key, version, changed_at)
+    SELECT 'conversation', new.conversation_id, 1, (julianday('now') - 2440587.5) * 86400.0
+    UNION ALL
+    SELECT 'user', user_id, 1, (julianday('now') - 2440587.5) * 86400.0
+    FROM conversation_members WHERE conversation_id = new.conversation_id
+    ON CONFLICT (scope, key) DO UPDATE
+    SET version = version + 1, changed_at = excluded.changed_at;
+END;
+
+CREATE TRIGGER IF NOT EXISTS change_counters_members_delete AFTER DELETE ON conversation_members
+BEGIN
+    INSERT INTO change_counters (scope, key, version, changed_at)
+    SELECT 'conversation', old.conversation_id, 1, (julianday('now') - 2440587.5) * 86400.0
+    UNION ALL
+    SELECT 'user', old.user_id, 1, (julianday('now') - 2440587.5) * 86400.0
+    UNION ALL
+    SELECT 'user', user_id, 1, (julianday('now') - 2440587.5) * 86400.0
+    FROM conversation_members WHERE conversation_id = old.conversation_id
+    ON CONFLICT (scope, key) DO UPDATE
+    SET version = version + 1, changed_at = excluded.changed_at;
+END;
+
+-- last_read_message_id (watermark model) is left out: the lists do not show
+-- it, and a read moves conversation_unread as well
+CREATE TRIGGER IF NOT EXISTS change_counters_members_update
+AFTER UPDATE OF conversation_id, user_id ON conversation_members
+BEGIN
+    INSERT INTO change_counters (scope, key, version, changed_at)
+    SELECT 'conversation', old.conversation_id, 1, (julianday('now') - 2440587.5) * 86400.0
+    UNION ALL
+    SELECT 'conversation', new.conversation_id, 1, (julianday('now') - 2440587.5) * 86400.0
+    WHERE new.conversation_id != old.conversation_id
+    UNION ALL
+    SELECT 'user', old.user_id, 1, (julianday('now') - 2440587.5) * 86400.0
+    WHERE new.user_id != old.user_id
+    UNION ALL
+    SELECT 'user', user_id, 1, (julianday('now') - 2440587.5) * 86400.0
+    FROM conversation_members
+    WHERE conversation_id IN (old.conversation_id, new.conversation_id)
+    ON CONFLICT (scope, key) DO UPDATE
+    SET version = version + 1, changed_at = excluded.changed_at;
+END;
+
+-- Conversation names and types appear in every member's conversation list
+CREATE TRIGGER IF NOT EXISTS change_counters_conversations_update AFTER UPDATE ON conversations
+BEGIN
+    INSERT INTO change_counters (scope, key, version, changed_at)
+    SELECT 'user', user_id, 1, (julianday('now') - 2440587.5) * 86400.0
+    FROM conversation_members WHERE conversation_id = new.id
+    ON CONFLICT (scope, key) DO UPDATE
+    SET version = version + 1, changed_at = excluded.changed_at;
+END;
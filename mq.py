@@ -0,0 +1,178 @@
+"""Socket.IO message-queue backends for running several app.py workers.
+
+Each worker only knows about the sockets connected to it, so room fan-out has
+to go through a message queue once there is more than one process. Set
+CHAT_MESSAGE_QUEUE on every worker:
+
+- ``redis://...``, ``amqp://...``, ``kafka://...``, ``zmq+tcp://...`` use the
+  backends built into python-socketio (install the matching client library).
+- ``local://host:port`` uses LocalQueueManager below, which talks to a small
+  broker started with ``python3 mq.py broker``. It needs no extra packages and
+  suits development, tests and single-machine deployments.
+"""
+import argparse
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import socketio
+
+_HEADER = struct.Struct('!I')
+PUBLISHER, SUBSCRIBER = b'P', b'S'
+
+
+def _send_frame(sock, payload):
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _recv_frame(sock):
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    return _recv_exact(sock, _HEADER.unpack(header)[0])
+
+
+def _parse_url(url):
+    host, _, port = url.split('://', 1)[1].rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        role = _recv_exact(self.request, 1)
+        if role == SUBSCRIBER:
+            self.server.subscribe(self.request)
+            # Subscribers never send; block until they disconnect
+            while self.request.recv(1024):
+                pass
+            self.server.unsubscribe(self.request)
+        elif role == PUBLISHER:
+            while True:
+                payload = _recv_frame(self.request)
+                if payload is None:
+                    break
+                self.server.publish(payload)
+
+
+class Broker(socketserver.ThreadingTCPServer):
+    """Relays every frame from any publisher to every subscriber"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, _BrokerHandler)
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, sock):
+        with self._lock:
+            self._subscribers[sock] = threading.Lock()
+
+    def unsubscribe(self, sock):
+        with self._lock:
+            self._subscribers.pop(sock, None)
+
+    def publish(self, payload):
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for sock, send_lock in subscribers:
+            try:
+                with send_lock:
+                    _send_frame(sock, payload)
+            except OSError:
+                self.unsubscribe(sock)
+
+
+class LocalQueueManager(socketio.PubSubManager):
+    """PubSubManager backed by the ``local://`` broker in this module"""
+    name = 'local'
+
+    def __init__(self, url='local://127.0.0.1:5590', channel='socketio',
+                 write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.address = _parse_url(url)
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+
+    def _connect(self, role):
+        sock = socket.create_connection(self.address)
+        sock.sendall(role)
+        return sock
+
+    def _publish(self, data):
+        payload = self.json.dumps(data).encode()
+        with self._publish_lock:
+            # One reconnect attempt covers a broker restart between messages
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect(PUBLISHER)
+                    _send_frame(self._publisher, payload)
+                    return
+                except OSError:
+                    if self._publisher is not None:
+                        self._publisher.close()
+                        self._publisher = None
+                    if attempt:
+                        raise
+
+    def _listen(self):
+        # PubSubManager stops listening for good if this generator returns,
+        # so reconnect to the broker forever instead
+        while True:
+            try:
+                sock = self._connect(SUBSCRIBER)
+            except OSError:
+                self._get_logger().error('Message queue broker %s:%s unreachable, '
+                                         'retrying', *self.address)
+                time.sleep(1)
+                continue
+            try:
+                while True:
+                    payload = _recv_frame(sock)
+                    if payload is None:
+                        break
+                    yield payload
+            except OSError:
+                pass
+            finally:
+                sock.close()
+            time.sleep(1)
+
+
+def socketio_options(url):
+    """SocketIO() keyword arguments for the message queue ``url`` (or None)"""
+    if not url:
+        return {}
+    if url.startswith('local://'):
+        return {'client_manager': LocalQueueManager(url)}
+    return {'message_queue': url}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the local:// message queue broker')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('broker', help='relay Socket.IO events between app.py workers')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=5590)
+    args = parser.parse_args()
+
+    with Broker((args.host, args.port)) as broker:
+        print(f'Message queue broker listening on local://{args.host}:{args.port}')
+        broker.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""Synthetic datasets for exercising the chat backend at realistic scale.
+
+``populate`` adds generated users, conversations, messages and read state to
+a migrated database. Everything it writes is consistent with what the app
+would have written itself: message_reads receipts (receipts read model),
+conversation_members.last_read_message_id watermarks and the
+conversation_unread counters all agree. Run it through
+``python3 manage.py seed``; bench.py uses it for its larger corpora.
+
+The shape of a generated dataset:
+
+- group sizes follow a Pareto distribution, so most groups are small and a
+  few are very large
+- conversation activity is skewed too: message counts per conversation follow
+  a Zipf-like curve, with groups weighted by their size
+- message times are spread over ``days`` with a daytime peak, and message ids
+  increase with time as they would in production
+- each member has read everything with probability ``read_ratio``; the others
+  stopped at a random point in the conversation
+"""
+import bisect
+import math
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+
+import migrate
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat.db.sql')
+
+WORDS = (
+    'the to and a of i you it is that in for on we be this have are with at '
+    'lunch meeting today tomorrow call deploy review build release branch '
+    'merge test fix bug issue ticket office coffee weekend plan team design '
+    'customer invoice report update server database query cache latency '
+    'thanks sure okay great later morning evening friday monday flight hotel '
+    'dinner project deadline budget slides demo standup sprint retro'
+).split()
+_WORD_WEIGHTS = [1 / rank for rank in range(1, len(WORDS) + 1)]
+
+# Rows per executemany()/transaction while bulk loading
+BATCH_SIZE = 50000
+
+
+def random_text(rng):
+    """A chat-like message: a few Zipf-distributed words, sometimes a rare one"""
+    words = rng.choices(WORDS, _WORD_WEIGHTS, k=rng.randint(3, 14))
+    if rng.random() < 0.01:
+        words.append(f'zq{rng.randrange(100000)}')
+    return ' '.join(words)
+
+
+def create(path):
+    """Create a database at ``path`` from chat.db.sql and apply every migration"""
+    conn = sqlite3.connect(path)
+    with open(SCHEMA) as f:
+        conn.executescript(f.read())
+    migrate.apply(conn, log=lambda message: None)
+    return conn
+
+
+def _timestamps(rng, count, days, end):
+    """``count`` sorted timestamps over the last ``days`` days, busiest mid-day"""
+    start = (end - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    stamps = []
+    for _ in range(count):
+        day = rng.randrange(days)
+        # Hours drawn around 14:00; wrapped so night time still sees some traffic
+        hour = rng.gauss(14, 4) % 24
+        stamps.append(start + timedelta(days=day, hours=hour))
+    stamps.sort()
+    return [s.strftime('%Y-%m-%d %H:%M:%S') for s in stamps]
+
+
+def _chunks(rows, size=BATCH_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def _read_counts(members, history, watermarks):
+    """(read count, message id) for every generated message read by someone:
+    the members other than the sender whose watermark has reached it"""
+    by_conversation = {conv_id: {} for conv_id in members}
+    for watermark, conv_id, user_id in watermarks:
+        by_conversation[conv_id][user_id] = watermark
+    counts = []
+    for conv_id, marks in by_conversation.items():
+        ordered = sorted(marks.values())
+        for message_id, sender in zip(*history[conv_id]):
+            count = len(ordered) - bisect.bisect_left(ordered, message_id)
+            if marks.get(sender, 0) >= message_id:
+                count -= 1
+            if count:
+                counts.append((count, message_id))
+    return counts
+
+
+def populate(conn, users=1000, dms=2000, groups=200, messages=100000,
+             group_size_min=3, group_size_max=500, group_size_alpha=1.2,
+             days=90, read_ratio=0.8, receipts=True, seed=0, log=print):
+    """Add a generated dataset to the migrated database behind ``conn``.
+
+    Existing users are part of the population, so the seeded demo accounts
+    end up in generated conversations too. With ``receipts=False`` no
+    message_reads rows are written (enough for CHAT_READ_MODEL=watermark and
+    much faster at scale). Returns a dict of row counts.
+    """
+    if migrate.pending(conn):
+        raise RuntimeError('Schema is out of date; run: python3 manage.py migrate')
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    conn.execute('PRAGMA foreign_keys = ON')
+    # A crash mid-seed leaves a half-seeded file anyway; skip the fsyncs
+    conn.execute('PRAGMA synchronous = OFF')
+
+    def step(message):
+        log(f'[{time.perf_counter() - started:6.1f}s] {message}')
+
+    # Users. Names are unique, so number them past whatever is there already.
+    first_user = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM users').fetchone()[0]
+    with conn:
+        conn.executemany('INSERT INTO users (name) VALUES (?)',
+                         ((f'user{first_user + i}',) for i in range(users)))
+    user_ids = [row[0] for row in conn.execute('SELECT id FROM users')]
+    step(f'{users} users ({len(user_ids)} in total)')
+
+    # Conversations and members
+    tag = conn.execute('SELECT COUNT(*) FROM conversations').fetchone()[0]
+    conversations, members = [], {}
+    for i in range(dms):
+        conv_id = f'dm-{tag}-{i}'
+        conversations.append((conv_id, f'DM {i}', 'direct'))
+        members[conv_id] = rng.sample(user_ids, 2)
+    for i in range(groups):
+        size = int(group_size_min * rng.paretovariate(group_size_alpha))
+        size = max(group_size_min, min(size, group_size_max, len(user_ids)))
+        conv_id = f'group-{tag}-{i}'
+        conversations.append((conv_id, f'Group {i}', 'group'))
+        members[conv_id] = rng.sample(user_ids, size)
+    with conn:
+        conn.executemany('INSERT INTO conversations (id, name, type) VALUES (?, ?, ?)',
+                         conversations)
+        conn.executemany(
+            'INSERT INTO conversation_members (conversation_id, user_id) VALUES (?, ?)',
+            ((conv_id, user_id) for conv_id, ids in members.items() for user_id in ids))
+    sizes = sorted(len(ids) for conv_id, ids in members.items() if conv_id.startswith('group-'))
+    step(f'{dms} direct and {groups} group conversations '
+         f'(group size median {sizes[len(sizes) // 2] if sizes else 0}, '
+         f'max {sizes[-1] if sizes else 0})')
+
+    # Messages: pick each message's conversation by activity weight, then
+    # assign ids and timestamps in time order
+    conv_ids = list(members)
+    order = list(range(len(conv_ids)))
+    rng.shuffle(order)
+    weights = [0.0] * len(conv_ids)
+    for rank, index in enumerate(order, 1):
+        weights[index] = math.sqrt(len(members[conv_ids[index]])) / rank ** 0.8
+    targets = rng.choices(conv_ids, weights, k=messages)
+    stamps = _timestamps(rng, messages, days, datetime.now(timezone.utc))
+    first_message = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM messages').fetchone()[0]
+
+    # Rebuilding the full-text index once is far cheaper than maintaining it
+    # row by row through its triggers
+    triggers = conn.execute('''
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'trigger' AND tbl_name = 'messages'
+    ''').fetchall()
+    with conn:
+        for name, _ in triggers:
+            conn.execute(f'DROP TRIGGER {name}')
+
+    history = {conv_id: ([], []) for conv_id in conv_ids}  # ids, senders
+    rows = []
+    for offset, (conv_id, stamp) in enumerate(zip(targets, stamps)):
+        message_id = first_message + offset
+        sender = rng.choice(members[conv_id])
+        history[conv_id][0].append(message_id)
+        history[conv_id][1].append(sender)
+        rows.append((message_id, conv_id, sender, random_text(rng), stamp))
+    try:
+        for chunk in _chunks(rows):
+            with conn:
+                conn.executemany('''
+                    INSERT INTO messages (id, conversation_id, sender_id, content, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', chunk)
+        step(f'{messages} messages over {days} days')
+    finally:
+        # Put the triggers back even if the load failed part way
+        with conn:
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+                conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            for _, sql in triggers:
+                conn.execute(sql)
+    del rows
+    if triggers:
+        step('full-text index rebuilt')
+
+    # Read state: one watermark per member, expanded into receipts and
+    # unread counters
+    watermarks, unread = [], []
+    for conv_id, ids in members.items():
+        message_ids, senders = history[conv_id]
+        for user_id in ids:
+            if not message_ids or rng.random() < read_ratio:
+                read = len(message_ids)
+            else:
+                read = rng.randrange(len(message_ids))
+            watermark = message_ids[read - 1] if read else 0
+            watermarks.append((watermark, conv_id, user_id))
+            count = sum(1 for sender in senders[read:] if sender != user_id)
+            unread.append((user_id, conv_id, count, watermark))
+    with conn:
+        conn.executemany('''
+            UPDATE conversation_members SET last_read_message_id = ?
+            WHERE conversation_id = ? AND user_id = ?
+        ''', watermarks)
+        conn.executemany('''
+            INSERT OR REPLACE INTO conversation_unread
+                (user_id, conversation_id, count, last_read_message_id)
+            VALUES (?, ?, ?, ?)
+        ''', unread)
+
+    reads = 0
+    if receipts:
+        # Per-message read counts are written once below rather than bumped
+        # by the message_reads triggers for every receipt
+        triggers = conn.execute('''
+            SELECT name, sql FROM sqlite_master
+            WHERE type = 'trigger' AND tbl_name = 'message_reads'
+        ''').fetchall()
+        with conn:
+            for name, _ in triggers:
+                conn.execute(f'DROP TRIGGER {name}')
+        try:
+            for chunk in _chunks(watermarks, 1000):
+                with conn:
+                    for watermark, conv_id, user_id in chunk:
+                        if not watermark:
+                            continue
+                        reads += conn.execute('''
+                            INSERT OR IGNORE INTO message_reads (message_id, user_id, read_at)
+                            SELECT id, ?, created_at FROM messages
+                            WHERE conversation_id = ? AND id BETWEEN ? AND ? AND sender_id != ?
+                        ''', (user_id, conv_id, history[conv_id][0][0], watermark,
+                              user_id)).rowcount
+            if triggers:
+                read_counts = _read_counts(members, history, watermarks)
+                for chunk in _chunks(read_counts):
+                    with conn:
+                        conn.executemany('UPDATE messages SET read_count = ? WHERE id = ?',
+                                         chunk)
+        finally:
+            with conn:
+                for _, sql in triggers:
+                    conn.execute(sql)
+    step(f'read state for {len(watermarks)} members ({reads} receipts)')
+
+    step('done')
+    return {
+        'users': users,
+        'conversations': len(conversations),
+        'members': len(watermarks),
+        'messages': messages,
+        'message_reads': reads,
+    }
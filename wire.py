@@ -0,0 +1,76 @@
+"""Response encodings negotiated per client.
+
+REST responses are JSON unless the client's Accept header prefers
+``application/msgpack`` (needs the ``msgpack`` package). Bodies larger than
+the configured threshold are compressed with brotli or gzip, whichever the
+client's Accept-Encoding prefers (brotli needs the ``brotli`` package). Both
+optional packages are used when installed and silently skipped otherwise.
+
+Socket.IO traffic is handled by the Socket.IO server instead: websocket frames
+use permessage-deflate whenever the client offers it, and the packet encoding
+is chosen server-wide (see CHAT_SOCKETIO_SERIALIZER in app.py).
+"""
+import gzip
+
+from flask import has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+ENCODERS = {'gzip': lambda body: gzip.compress(body, compresslevel=5)}
+if brotli is not None:
+    ENCODERS = {'br': lambda body: brotli.compress(body, quality=5), **ENCODERS}
+
+
+def wants_msgpack(req):
+    """True if the request prefers MessagePack over JSON and we can send it"""
+    if msgpack is None:
+        return False
+    best = req.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES)
+    return best in MSGPACK_MIMETYPES
+
+
+def pack(obj):
+    return msgpack.packb(obj, default=str)
+
+
+class NegotiatingJSONProvider(DefaultJSONProvider):
+    """Makes jsonify() answer in MessagePack when the client asks for it"""
+
+    def response(self, *args, **kwargs):
+        if has_request_context() and wants_msgpack(request):
+            obj = self._prepare_response_obj(args, kwargs)
+            response = self._app.response_class(pack(obj), mimetype=MSGPACK_MIMETYPES[0])
+            response.vary.add('Accept')
+            return response
+        response = super().response(*args, **kwargs)
+        if msgpack is not None:
+            response.vary.add('Accept')
+        return response
+
+
+def compress(response, req, min_size=1024):
+    """Compress ``response`` in place with the client's preferred encoding"""
+    if (response.direct_passthrough or response.status_code in (204, 304)
+            or response.status_code < 200 or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < min_size:
+        return response
+    encoding = req.accept_encodings.best_match(list(ENCODERS))
+    if encoding is None:
+        return response
+    response.set_data(ENCODERS[encoding](body))
+    response.headers['Content-Encoding'] = encoding
+    return response